@@ -0,0 +1,68 @@
+import csv
+import json
+import numpy
+
+# Deterministic synthetic inputs for the benchmarks. The same arguments always produce the
+# same files, so timings from different runs are comparable.
+
+# Fires are placed inside the terrain model's bounding box so none are filtered out
+FIRE_LATITUDE_RANGE = (32, 42)
+FIRE_LONGITUDE_RANGE = (-125, -114)
+
+FIRE_CSV_COLUMNS = [
+    'fod_id', 'fire_name', 'fire_year', 'discovery_date', 'discovery_doy', 'discovery_time',
+    'stat_cause_code', 'stat_cause_descr', 'cont_date', 'cont_doy', 'cont_time', 'fire_size',
+    'fire_size_class', 'latitude', 'longitude', 'state'
+]
+
+# A satellite-like RGB raster: blocks of land, vegetation and water colors with pixel noise
+def generate_raster(width, height, seed=0, block_size=64):
+    random = numpy.random.RandomState(seed)
+    palette = numpy.array([
+        [194, 178, 128], [160, 120, 80], [90, 110, 60], [40, 80, 40], [30, 60, 120], [200, 200, 200]])
+    blocks = random.randint(0, len(palette), (height // block_size + 1, width // block_size + 1))
+    colors = palette[blocks.repeat(block_size, axis=0).repeat(block_size, axis=1)[:height, :width]]
+    noise = random.randint(-20, 21, (height, width, 3))
+    return numpy.clip(colors + noise, 0, 255).astype(numpy.uint8)
+
+# Fire list in the schema of terrain/json/*.json
+def generate_fire_json(number_of_fires, seed=0):
+    random = numpy.random.RandomState(seed)
+    return {
+        'fire_areas': random.randint(100, 300000, number_of_fires).tolist(),
+        'firenames': ['Fire ' + str(index) for index in range(number_of_fires)],
+        'fire_lons': numpy.round(random.uniform(*FIRE_LONGITUDE_RANGE, number_of_fires), 3).tolist(),
+        'states': [6] * number_of_fires,
+        'fire_lats': numpy.round(random.uniform(*FIRE_LATITUDE_RANGE, number_of_fires), 3).tolist(),
+        'inciwebs': [''] * number_of_fires,
+        'start_dates': random.randint(101, 1231, number_of_fires).tolist(),
+        'end_dates': random.randint(0, 31, number_of_fires).tolist()
+    }
+
+def write_fire_json(file_name, number_of_fires, seed=0):
+    with open(file_name, 'w') as json_file:
+        json.dump(generate_fire_json(number_of_fires, seed), json_file)
+
+# Fires in the schema of the US Forest Service data/us_fires_*.csv files. Locations cluster
+# around a number of hot spots so cells see many fires, as in the real data.
+def write_fire_csv(file_name, number_of_rows, seed=0, first_year=1992, last_year=2015, hot_spots=500):
+    random = numpy.random.RandomState(seed)
+    centers = numpy.column_stack([random.uniform(25, 49, hot_spots), random.uniform(-124, -67, hot_spots)])
+    spots = random.randint(0, hot_spots, number_of_rows)
+    latitudes = numpy.round(centers[spots, 0] + random.normal(0, 0.5, number_of_rows), 6)
+    longitudes = numpy.round(centers[spots, 1] + random.normal(0, 0.5, number_of_rows), 6)
+    years = random.randint(first_year, last_year + 1, number_of_rows)
+    months = random.randint(1, 13, number_of_rows)
+    days = random.randint(1, 29, number_of_rows)
+    causes = random.randint(1, 14, number_of_rows)
+    sizes = numpy.round(random.exponential(20, number_of_rows), 2)
+    missing_discovery = random.random_sample(number_of_rows) < 0.01
+
+    with open(file_name, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(FIRE_CSV_COLUMNS)
+        for row in range(number_of_rows):
+            date = '%d-%02d-%02d' % (years[row], months[row], days[row])
+            writer.writerow([
+                row, 'FIRE ' + str(row), years[row], '' if missing_discovery[row] else date, 1, '',
+                causes[row], '', date, 1, '', sizes[row], 'A', latitudes[row], longitudes[row], 'CA'])
@@ -0,0 +1,193 @@
+from generate import generate_raster, write_fire_json, write_fire_csv
+
+import importlib.util
+import json
+import numpy
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TERRAIN_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'terrain')
+TIME_SERIES_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'time-series')
+COMMON_DIRECTORY = os.path.join(ROOT_DIRECTORY, 'common')
+sys.path[:0] = [TERRAIN_DIRECTORY, TIME_SERIES_DIRECTORY, COMMON_DIRECTORY]
+
+from process import process_csvs
+from learn import Predictor
+from merge import merge_for_render
+
+import pandas
+
+# terrain/main.py and time-series/main.py share a module name, so the terrain model is loaded
+# from its path under a name of its own
+terrain_spec = importlib.util.spec_from_file_location('terrain_main', os.path.join(TERRAIN_DIRECTORY, 'main.py'))
+terrain = importlib.util.module_from_spec(terrain_spec)
+terrain_spec.loader.exec_module(terrain)
+
+RESULTS_FILENAME = 'results.json'
+REPEATS = 3
+# A benchmark is reported as a regression when it is this much slower than the baseline
+REGRESSION_THRESHOLD = 0.1
+
+TERRAIN_YEAR = '2019'
+FIRST_YEAR = 1992
+LAST_YEAR = 2015
+PREDICT_START = 2016
+PREDICT_END = 2024
+
+# Input sizes: raster edge in pixels, fires in the terrain JSON and rows in the fires CSV
+SIZES = {
+    'small': {'raster': 512, 'fires': 100, 'rows': 20000},
+    'medium': {'raster': 1024, 'fires': 500, 'rows': 200000},
+    'large': {'raster': 4096, 'fires': 1000, 'rows': 2000000}
+}
+DEFAULT_SIZES = ['small', 'medium']
+
+# Best of repeats, as the minimum is the least affected by other load on the machine
+def time_call(function, repeats, setup=None):
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+# Inputs for one size, written to the working directory the way each model expects them
+def prepare_inputs(size, seed):
+    os.makedirs('images')
+    os.makedirs('json')
+    os.makedirs('output')
+    os.makedirs('csv_outputs')
+    os.makedirs('render')
+
+    image = generate_raster(size['raster'], size['raster'], seed)
+    terrain.Image.fromarray(image).save('images/synthetic-' + TERRAIN_YEAR + '.png')
+    write_fire_json('json/fires-' + TERRAIN_YEAR + '.json', size['fires'], seed)
+    # Averages shaped like the model's output, so predict renders a realistic overlay
+    with open(terrain.AVERAGES_DATA_FILE, 'w') as averages_file:
+        averages_file.write('%s,%s,%s,%s\n' % ((terrain.AVERAGES_BINS_HEADER,) + terrain.FeatureBins().settings()))
+        for hue_bin in range(terrain.HUE_BINS):
+            averages_file.write('%s,%s\n' % (hue_bin / terrain.HUE_SCALE, 20000 + 80000 * abs(hue_bin / terrain.HUE_SCALE - 0.3)))
+
+    write_fire_csv('us_fires.csv', size['rows'], seed, FIRST_YEAR, LAST_YEAR)
+    return image
+
+def run_benchmarks(size_names, repeats, seed=0):
+    results = []
+    working_directory = os.getcwd()
+    for size_name in size_names:
+        size = SIZES[size_name]
+        directory = tempfile.mkdtemp(prefix='wildfire-benchmark-')
+        os.chdir(directory)
+        try:
+            print("Generating " + size_name + " inputs...")
+            image = prepare_inputs(size, seed)
+
+            def record(name, items, function, setup=None):
+                print("Timing " + name + " (" + size_name + ")...")
+                times = time_call(function, repeats, setup)
+                results.append({
+                    'benchmark': name,
+                    'size': size_name,
+                    'items': items,
+                    'seconds': min(times),
+                    'times': times,
+                    'items_per_second': items / min(times)
+                })
+
+            # A cold parse, projecting every fire again
+            record(
+                'terrain.parseJson',
+                size['fires'],
+                lambda: terrain.parseJson(TERRAIN_YEAR, image.shape),
+                lambda: shutil.rmtree(terrain.CACHE_DIRECTORY, ignore_errors=True))
+            fire_locations = terrain.parseJson(TERRAIN_YEAR, image.shape)
+            windows = (image.shape[0] - terrain.SAMPLE_SIZE_Y + 1) * (image.shape[1] - terrain.SAMPLE_SIZE_X + 1)
+            record('terrain.processImage', windows, lambda: terrain.processImage(image, fire_locations))
+            record('terrain.predict', image.shape[0] * image.shape[1], lambda: terrain.predict([TERRAIN_YEAR]))
+
+            record(
+                'time-series.process_csvs',
+                size['rows'],
+                lambda: process_csvs(['us_fires.csv'], 'csv_outputs/processed.csv'))
+            frame = pandas.read_csv('csv_outputs/processed.csv', float_precision='round_trip')
+            predictor = Predictor(FIRST_YEAR, LAST_YEAR, PREDICT_START, PREDICT_END)
+            predictor.add_data_points(frame)
+            cells = int(predictor.fire_tensor.active_cells().sum())
+            predictions = []
+            record(
+                'time-series.Predictor.predict',
+                cells,
+                lambda: predictions.append(pandas.concat(predictor.predict(), ignore_index=True)))
+            predictions[-1].to_csv('csv_outputs/predict.csv', index=False)
+            record(
+                'time-series.merge_for_render',
+                len(frame) + len(predictions[-1]),
+                lambda: merge_for_render(
+                    'csv_outputs/processed.csv', 'csv_outputs/predict.csv', 'render/', FIRST_YEAR, PREDICT_END))
+        finally:
+            os.chdir(working_directory)
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def save_results(results, file_name, repeats, seed):
+    with open(file_name, 'w') as results_file:
+        json.dump({
+            'environment': {
+                'python': platform.python_version(),
+                'numpy': numpy.__version__,
+                'pandas': pandas.__version__,
+                'machine': platform.machine(),
+                'processors': os.cpu_count()
+            },
+            'repeats': repeats,
+            'seed': seed,
+            'results': results
+        }, results_file, indent=2)
+
+# Prints the change in best time of every benchmark found in both files. Returns the
+# benchmarks that got slower by more than the threshold.
+def compare_results(baseline_file_name, candidate_file_name, threshold=REGRESSION_THRESHOLD):
+    with open(baseline_file_name) as baseline_file:
+        baseline = {(result['benchmark'], result['size']): result for result in json.load(baseline_file)['results']}
+    with open(candidate_file_name) as candidate_file:
+        candidate = json.load(candidate_file)['results']
+
+    regressions = []
+    for result in candidate:
+        key = (result['benchmark'], result['size'])
+        if key not in baseline:
+            continue
+        ratio = result['seconds'] / baseline[key]['seconds']
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(key)
+        print('%-32s %-8s %10.4fs %10.4fs %+7.1f%%%s' % (
+            key[0], key[1], baseline[key]['seconds'], result['seconds'], (ratio - 1) * 100,
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+def option_value(name, default=None):
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "compare":
+        threshold = float(option_value("--threshold", REGRESSION_THRESHOLD))
+        if compare_results(sys.argv[2], sys.argv[3], threshold):
+            sys.exit(1)
+    else:
+        size_names = option_value("--sizes", ",".join(DEFAULT_SIZES)).split(",")
+        repeats = int(option_value("--repeats", REPEATS))
+        seed = int(option_value("--seed", 0))
+        output_file_name = os.path.abspath(option_value("--output", RESULTS_FILENAME))
+        results = run_benchmarks(size_names, repeats, seed)
+        save_results(results, output_file_name, repeats, seed)
+        print("Results written to " + output_file_name)
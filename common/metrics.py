@@ -0,0 +1,178 @@
+import atexit
+import cProfile
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+# Settings are passed through the environment so worker processes record to the same file
+METRICS_FILE_VARIABLE = 'WILDFIRE_METRICS_FILE'
+PROFILE_STAGES_VARIABLE = 'WILDFIRE_PROFILE_STAGES'
+PROFILE_DIRECTORY_VARIABLE = 'WILDFIRE_PROFILE_DIRECTORY'
+RUN_VARIABLE = 'WILDFIRE_METRICS_RUN'
+
+# Each pipeline passes its own output directory
+PROFILE_DIRECTORY = 'profiles/'
+
+# Linux keeps a resettable high-water mark of each process's resident set size
+CLEAR_REFS_FILE = '/proc/self/clear_refs'
+STATUS_FILE = '/proc/self/status'
+RESET_PEAK_RSS = '5'
+
+# Stages timed in this process, whether a profiler is already running in it, and the peak
+# resident set size seen so far by each stage that is still open, innermost last
+records = []
+profiling = [False]
+open_peaks = []
+
+# Timings of one stage. count() adds to the number of items it handled.
+class StageTimer:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+
+    def count(self, items):
+        self.items += int(items)
+
+# Records metrics to file_name as JSON lines and prints a summary when the process exits.
+# Stages named in profile_stages are also run under cProfile.
+def configure(file_name=None, profile_stages=(), profile_directory=PROFILE_DIRECTORY):
+    # Without a file, worker processes still report to a temporary one read back at exit
+    temporary = file_name is None
+    if temporary:
+        descriptor, file_name = tempfile.mkstemp(prefix='metrics-', suffix='.jsonl')
+        os.close(descriptor)
+    os.environ[METRICS_FILE_VARIABLE] = os.path.abspath(file_name)
+    if profile_stages:
+        os.environ[PROFILE_STAGES_VARIABLE] = ','.join(profile_stages)
+        os.environ[PROFILE_DIRECTORY_VARIABLE] = os.path.abspath(profile_directory)
+    os.environ[RUN_VARIABLE] = '%d-%d' % (os.getpid(), time.time())
+    # Exit handlers run last in first out, so the temporary file is removed after the summary
+    if temporary:
+        atexit.register(os.remove, os.path.abspath(file_name))
+    atexit.register(print_summary)
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+# Resets this process's resident set size high-water mark to its current size, and returns
+# whether it could. Elsewhere than on Linux the mark only ever grows.
+def reset_peak_rss():
+    try:
+        with open(CLEAR_REFS_FILE, 'w') as clear_refs:
+            clear_refs.write(RESET_PEAK_RSS)
+        return True
+    except OSError:
+        return False
+
+# High-water mark of this process's resident set size since it was last reset, in megabytes
+def peak_rss_megabytes():
+    try:
+        with open(STATUS_FILE) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Linux reports kilobytes, macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+# Raises the peak of every open stage to the high-water mark before it is reset or read
+def fold_peak_rss():
+    peak = peak_rss_megabytes()
+    for index, open_peak in enumerate(open_peaks):
+        open_peaks[index] = max(open_peak, peak)
+
+@contextmanager
+def stage(name):
+    timer = StageTimer(name)
+    profile_stages = os.environ.get(PROFILE_STAGES_VARIABLE, '').split(',')
+    profiler = None
+    if name in profile_stages and not profiling[0]:
+        profiler = cProfile.Profile()
+        profiling[0] = True
+        profiler.enable()
+
+    # The high-water mark is reset when a stage starts, so it only sees this stage's peak. The
+    # stages around it keep the peak from before the reset.
+    fold_peak_rss()
+    open_peaks.append(0.0)
+    reset_peak_rss()
+    start_wall = time.perf_counter()
+    start_cpu = cpu_seconds()
+    try:
+        yield timer
+    finally:
+        wall_seconds = time.perf_counter() - start_wall
+        fold_peak_rss()
+        record = {
+            'run': os.environ.get(RUN_VARIABLE),
+            'pid': os.getpid(),
+            'time': time.time(),
+            'stage': name,
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds() - start_cpu,
+            'peak_rss_mb': open_peaks.pop(),
+            'items': timer.items,
+            'items_per_second': timer.items / wall_seconds if wall_seconds > 0 else None
+        }
+        if profiler is not None:
+            profiler.disable()
+            profiling[0] = False
+            profile_directory = os.environ[PROFILE_DIRECTORY_VARIABLE]
+            if not os.path.exists(profile_directory):
+                os.makedirs(profile_directory, exist_ok=True)
+            record['profile'] = os.path.join(profile_directory, '%s-%d-%d.prof' % (name, os.getpid(), len(records)))
+            profiler.dump_stats(record['profile'])
+        write_record(record)
+
+# Lines are appended in one write each, so processes can share the file
+def write_record(record):
+    records.append(record)
+    file_name = os.environ.get(METRICS_FILE_VARIABLE)
+    if file_name is not None:
+        with open(file_name, 'a') as metrics_file:
+            metrics_file.write(json.dumps(record) + '\n')
+
+# This run's records, including the ones worker processes wrote to the metrics file
+def run_records():
+    file_name = os.environ.get(METRICS_FILE_VARIABLE)
+    if file_name is None or not os.path.exists(file_name):
+        return records
+    run = os.environ.get(RUN_VARIABLE)
+    with open(file_name) as metrics_file:
+        file_records = [json.loads(line) for line in metrics_file if line.strip()]
+    worker_records = [record for record in file_records if record['run'] == run and record['pid'] != os.getpid()]
+    return sorted(records + worker_records, key=lambda record: record['time'])
+
+# One line per stage, totalled over every time it ran, in the order stages first finished. The
+# rss column is the largest resident set size any run of the stage reached in its process.
+def print_summary():
+    all_records = run_records()
+    totals = {}
+    for record in all_records:
+        total = totals.setdefault(record['stage'], {'runs': 0, 'wall': 0.0, 'cpu': 0.0, 'rss': 0.0, 'items': 0})
+        total['runs'] += 1
+        total['wall'] += record['wall_seconds']
+        total['cpu'] += record['cpu_seconds']
+        total['rss'] = max(total['rss'], record['peak_rss_mb'])
+        total['items'] += record['items']
+    if not totals:
+        return
+
+    print('%-24s %5s %10s %10s %10s %12s %12s' % ('stage', 'runs', 'wall (s)', 'cpu (s)', 'rss (MB)', 'items', 'items/s'))
+    for name, total in totals.items():
+        rate = '%12.0f' % (total['items'] / total['wall']) if total['items'] and total['wall'] > 0 else '%12s' % '-'
+        print('%-24s %5d %10.3f %10.3f %10.1f %12d %s' % (
+            name, total['runs'], total['wall'], total['cpu'], total['rss'], total['items'], rate))
+    profiles = {}
+    for record in all_records:
+        if 'profile' in record:
+            profiles.setdefault(record['stage'], []).append(record['profile'])
+    for name, files in profiles.items():
+        print('%d profile(s) of %s written to %s' % (len(files), name, os.path.dirname(files[0])))
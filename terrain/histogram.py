@@ -0,0 +1,109 @@
+import numpy
+
+# Histograms with more bins than this only hold the bins they have seen
+DENSE_BIN_LIMIT = 2 ** 20
+NEVER_SEEN = numpy.iinfo(numpy.int64).max
+
+# Distance sum, window count and first appearance of every bin of a histogram with binCount
+# bins. A small histogram holds an entry for every bin, indexed by the bin's code. A large one
+# holds the sorted codes of the bins it has seen and an entry for each of them. Histograms merge
+# associatively, so partials from different years can be computed in any order and combined
+# afterwards.
+class BinHistogram:
+    def __init__(self, binCount, sums, counts, firstSeen, codes=None):
+        self.binCount = binCount
+        self.sums = sums
+        self.counts = counts
+        self.firstSeen = firstSeen
+        self.codes = codes
+
+    @staticmethod
+    def isDense(binCount):
+        return binCount <= DENSE_BIN_LIMIT
+
+    @staticmethod
+    def empty(binCount):
+        if BinHistogram.isDense(binCount):
+            return BinHistogram(binCount, numpy.zeros(binCount), numpy.zeros(binCount, dtype=numpy.int64), numpy.full(binCount, NEVER_SEEN))
+        return BinHistogram(binCount, numpy.zeros(0), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+
+    # Histogram of samples falling in the bins given by codes. scanIndexes maps the position of
+    # each bin's first sample to the position the bin is ordered by.
+    @staticmethod
+    def fromSamples(binCount, codes, weights, scanIndexes):
+        presentCodes, firstIndexes, inverse = numpy.unique(codes, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        sums = numpy.bincount(inverse, weights=weights, minlength=len(presentCodes))
+        counts = numpy.bincount(inverse, minlength=len(presentCodes))
+        firstSeen = scanIndexes(firstIndexes)
+        if not BinHistogram.isDense(binCount):
+            return BinHistogram(binCount, sums, counts, firstSeen, presentCodes)
+        histogram = BinHistogram.empty(binCount)
+        histogram.sums[presentCodes] = sums
+        histogram.counts[presentCodes] = counts
+        histogram.firstSeen[presentCodes] = firstSeen
+        return histogram
+
+    def merge(self, other):
+        if self.codes is None:
+            return BinHistogram(
+                self.binCount,
+                self.sums + other.sums,
+                self.counts + other.counts,
+                numpy.minimum(self.firstSeen, other.firstSeen))
+        codes = numpy.union1d(self.codes, other.codes)
+        merged = BinHistogram(
+            self.binCount,
+            numpy.zeros(len(codes)),
+            numpy.zeros(len(codes), dtype=numpy.int64),
+            numpy.full(len(codes), NEVER_SEEN),
+            codes)
+        for histogram in (self, other):
+            positions = numpy.searchsorted(codes, histogram.codes)
+            merged.sums[positions] += histogram.sums
+            merged.counts[positions] += histogram.counts
+            merged.firstSeen[positions] = numpy.minimum(merged.firstSeen[positions], histogram.firstSeen)
+        return merged
+
+    # Codes, distance sums and counts of the bins with at least one sample, in the order they
+    # were first seen
+    def seenBins(self):
+        seen = numpy.flatnonzero(self.counts)
+        seen = seen[numpy.argsort(self.firstSeen[seen], kind='stable')]
+        codes = seen if self.codes is None else self.codes[seen]
+        return codes, self.sums[seen], self.counts[seen]
+
+    def toArrays(self):
+        arrays = {'binCount': self.binCount, 'sums': self.sums, 'counts': self.counts, 'firstSeen': self.firstSeen}
+        if self.codes is not None:
+            arrays['codes'] = self.codes
+        return arrays
+
+    @staticmethod
+    def fromArrays(arrays):
+        codes = arrays['codes'] if 'codes' in arrays else None
+        return BinHistogram(int(arrays['binCount']), arrays['sums'], arrays['counts'], arrays['firstSeen'], codes)
+
+# A value for every bin of a histogram, looked up by indexing with an array of bin codes. Small
+# tables hold every bin. Large ones hold the sorted codes that have a value and return default
+# for the others.
+class BinTable:
+    def __init__(self, binCount, codes, values, default=0):
+        self.binCount = binCount
+        if BinHistogram.isDense(binCount):
+            self.values = numpy.full(binCount, default, dtype=numpy.asarray(values).dtype)
+            self.values[codes] = values
+            self.codes = None
+        else:
+            order = numpy.argsort(codes)
+            self.codes = numpy.asarray(codes)[order]
+            self.values = numpy.asarray(values)[order]
+        self.default = default
+
+    def __getitem__(self, codes):
+        if self.codes is None:
+            return self.values[codes]
+        if len(self.codes) == 0:
+            return numpy.full(numpy.shape(codes), self.default, dtype=self.values.dtype)
+        positions = numpy.minimum(numpy.searchsorted(self.codes, codes), len(self.codes) - 1)
+        return numpy.where(self.codes[positions] == codes, self.values[positions], self.default)
@@ -1,13 +1,26 @@
-import colorsys
+import numpy
 import pyproj
 import glob
+import hashlib
 import json
 import math
+import nearest
+import histogram
+import tiles
 import matplotlib.pyplot as plot
 import csv
+import os
 import sys
+from functools import partial, reduce
+from multiprocessing import Pool
 from PIL import Image, ImageDraw
 
+# Stage metrics are shared with the time series pipeline in ../common
+COMMON_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+if COMMON_DIRECTORY not in sys.path:
+    sys.path.append(COMMON_DIRECTORY)
+import metrics
+
 YEAR_START = 2003
 YEAR_END = 2019
 
@@ -18,163 +31,527 @@ TOP_RIGHT_LNG = -114
 
 OCEAN_EXCLUSION_RANGE = [0.5, 0.8]
 
-EPSG_4326 = pyproj.Proj('EPSG:4326')
-EPSG_3785 = pyproj.Proj('EPSG:3785')
-
-BOTTOM_LEFT_EPSG_3785 = pyproj.transform(EPSG_4326, EPSG_3785, BOTTOM_LEFT_LAT, BOTTOM_LEFT_LNG)
-TOP_RIGHT_EPSG_3785 = pyproj.transform(EPSG_4326, EPSG_3785, TOP_RIGHT_LAT, TOP_RIGHT_LNG)
+# The transformer uses the authority axis order, so EPSG:4326 coordinates are (lat, lng)
+TO_EPSG_3785 = pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:3785')
 
-REFERENCE_IMAGE_WIDTH_PX = 3998
-REFERENCE_IMAGE_HEIGHT_PX = 4551
+BOTTOM_LEFT_EPSG_3785, TOP_RIGHT_EPSG_3785 = zip(*TO_EPSG_3785.transform(
+    [BOTTOM_LEFT_LAT, TOP_RIGHT_LAT],
+    [BOTTOM_LEFT_LNG, TOP_RIGHT_LNG]))
 
-METERS_PER_PIXEL_X =  (TOP_RIGHT_EPSG_3785[0] - BOTTOM_LEFT_EPSG_3785[0]) / (REFERENCE_IMAGE_WIDTH_PX)
-METERS_PER_PIXEL_Y = (TOP_RIGHT_EPSG_3785[1] - BOTTOM_LEFT_EPSG_3785[1]) / (REFERENCE_IMAGE_HEIGHT_PX)
+# Meters per pixel along x and y for a raster of the given size. Every raster covers the
+# bounding box above, whatever its size.
+def metersPerPixel(width, height):
+    return (TOP_RIGHT_EPSG_3785[0] - BOTTOM_LEFT_EPSG_3785[0]) / width, (TOP_RIGHT_EPSG_3785[1] - BOTTOM_LEFT_EPSG_3785[1]) / height
 
 SAMPLE_SIZE_X = 3
 SAMPLE_SIZE_Y = 3
 SIGNIFICANCE_THRESHOLD_PX = 20
 
+# Hues are rounded to multiples of 1 / HUE_SCALE, giving HUE_BINS buckets in [0, 1]. The
+# default of 101 bins rounds them to two decimal places.
+HUE_BINS = 101
+HUE_SCALE = HUE_BINS - 1
+# With more than one saturation or value bin, windows are binned jointly by hue, saturation and
+# value. Saturation and value are split into bins of equal width.
+SATURATION_BINS = 1
+VALUE_BINS = 1
+
+# Images are sampled and rendered in tiles of at most TILE_SIZE_PX x TILE_SIZE_PX windows, so
+# memory use does not grow with the size of the raster
+TILE_SIZE_PX = 1024
+
 AVERAGES_DATA_FILE = "output/averages.txt"
+PROFILE_DIRECTORY = "output/profiles/"
+# First field of the row at the top of the averages holding the bins they were written with
+AVERAGES_BINS_HEADER = "bins"
 AVERAGES_GRAPH = "output/averages.png"
 PREDICTION_IMAGE = "output/prediction.bmp"
+PREDICTION_IMAGE_FOR_YEAR = "output/prediction-{}.bmp"
+CACHE_DIRECTORY = "cache/"
+IMAGE_CACHE_DIRECTORY = CACHE_DIRECTORY + "images/"
+PARTIALS_DIRECTORY = "output/partials/"
 
-def pixelToCoordinate(x, y):
-    epsg3785X = (TOP_RIGHT_EPSG_3785[0] - BOTTOM_LEFT_EPSG_3785[0]) * (x / REFERENCE_IMAGE_WIDTH_PX) + BOTTOM_LEFT_EPSG_3785[0]
-    epsg3785Y = (TOP_RIGHT_EPSG_3785[1] - BOTTOM_LEFT_EPSG_3785[1]) * (y / REFERENCE_IMAGE_HEIGHT_PX) + BOTTOM_LEFT_EPSG_3785[1]
-    return pyproj.transform(EPSG_3785, EPSG_4326, epsg3785X, epsg3785Y)
+# Orders first appearances across years: a window's scan index always fits below this stride
+FIRST_SEEN_YEAR_STRIDE = 2 ** 40
 
-def coordinateToPixel(lat, lng):
-    epsg3785X = pyproj.transform(EPSG_4326, EPSG_3785, lat, lng)[0]
-    epsg3785Y = pyproj.transform(EPSG_4326, EPSG_3785, lat, lng)[1]
+# Works on scalars or on whole arrays of coordinates, projected onto a raster of the given size
+def coordinatesToPixels(lat, lng, width, height):
+    epsg3785X, epsg3785Y = TO_EPSG_3785.transform(lat, lng)
 
-    pX = REFERENCE_IMAGE_WIDTH_PX * (epsg3785X - BOTTOM_LEFT_EPSG_3785[0]) / (TOP_RIGHT_EPSG_3785[0] - BOTTOM_LEFT_EPSG_3785[0])
-    pY = REFERENCE_IMAGE_HEIGHT_PX * (epsg3785Y - BOTTOM_LEFT_EPSG_3785[1]) / (TOP_RIGHT_EPSG_3785[1] - BOTTOM_LEFT_EPSG_3785[1])
+    pX = width * (epsg3785X - BOTTOM_LEFT_EPSG_3785[0]) / (TOP_RIGHT_EPSG_3785[0] - BOTTOM_LEFT_EPSG_3785[0])
+    pY = height * (epsg3785Y - BOTTOM_LEFT_EPSG_3785[1]) / (TOP_RIGHT_EPSG_3785[1] - BOTTOM_LEFT_EPSG_3785[1])
     return (pX, pY)
 
-def openImage(year):
-    files = glob.glob('./images/*' + year + '*.png')
+# Images are PNGs, or (height, width, 3) uint8 .npy rasters for sources too large to decode
+def findImageFile(year):
+    files = glob.glob('./images/*' + year + '*.png') + glob.glob('./images/*' + year + '*.npy')
     if len(files) == 0:
         raise Exception("Can't find image file for " + str(year))
-    image = Image.open(files[0])
-    pixels = image.load()
-    return pixels
-
-def parseJson(year):
+    return files[0]
+
+# Decoded copy of a PNG as a (height, width, 3) uint8 .npy file, keyed by the PNG's path, size
+# and modification time. The copy is written under a temporary name and then renamed, so
+# worker processes decoding the same image never read a partly written file.
+def decodedImageFile(fileName):
+    status = os.stat(fileName)
+    key = hashlib.sha1(str((os.path.abspath(fileName), status.st_size, status.st_mtime_ns)).encode()).hexdigest()
+    baseName = os.path.splitext(os.path.basename(fileName))[0]
+    cacheFile = IMAGE_CACHE_DIRECTORY + baseName + "-" + key + ".npy"
+    if os.path.exists(cacheFile):
+        return cacheFile
+
+    if not os.path.exists(IMAGE_CACHE_DIRECTORY):
+        os.makedirs(IMAGE_CACHE_DIRECTORY, exist_ok=True)
+    with metrics.stage("decodeImage") as timer:
+        pixels = numpy.asarray(Image.open(fileName).convert('RGB'))
+        timer.count(pixels.shape[0] * pixels.shape[1])
+        temporaryFile = cacheFile + "." + str(os.getpid()) + ".tmp"
+        with open(temporaryFile, 'wb') as file:
+            numpy.save(file, pixels)
+        os.replace(temporaryFile, cacheFile)
+    for staleFile in glob.glob(IMAGE_CACHE_DIRECTORY + glob.escape(baseName) + "-" + "?" * len(key) + ".npy"):
+        if staleFile != cacheFile:
+            os.remove(staleFile)
+    return cacheFile
+
+# A (height, width, 3) uint8 array indexed [y, x]. It is memory mapped, so tiles are only read
+# from disk when they are sliced and processes opening the same year share one copy in the
+# page cache. PNGs are only decoded the first time they are opened.
+def openImageArray(year):
+    fileName = findImageFile(year)
+    if not fileName.endswith('.npy'):
+        fileName = decodedImageFile(fileName)
+    return numpy.load(fileName, mmap_mode='r')
+
+def findJsonFile(year):
     files = glob.glob('./json/*' + year + '*.json')
     if len(files) == 0:
         raise Exception("Can't find JSON file for " + str(year))
-    file = open(files[0])
-    fireInfo = json.load(file)
-    locations = [location for location in list(zip(fireInfo['fire_lats'], fireInfo['fire_lons'])) if isLocationInBounds(location)]
-    pixelLocations = [coordinateToPixel(location[0], location[1]) for location in locations]
+    return files[0]
+
+def fileDigest(fileName):
+    digest = hashlib.sha1()
+    with open(fileName, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Pixel locations of the year's fires as an (n, 2) array, projected onto a raster of the given
+# (height, width), which is the year's own raster when it isn't given. Projecting is cached on
+# disk, keyed by the JSON contents and the image geometry they were projected onto.
+def parseJson(year, imageShape=None):
+    height, width = (openImageArray(year).shape if imageShape is None else imageShape)[:2]
+    fileName = findJsonFile(year)
+    with open(fileName, 'rb') as file:
+        contents = file.read()
+    geometry = str((BOTTOM_LEFT_LAT, BOTTOM_LEFT_LNG, TOP_RIGHT_LAT, TOP_RIGHT_LNG, width, height))
+    digest = hashlib.sha1(contents + geometry.encode()).hexdigest()
+    cacheFile = CACHE_DIRECTORY + "fires-" + year + "-" + digest + ".npy"
+    if os.path.exists(cacheFile):
+        return numpy.load(cacheFile)
+
+    with metrics.stage("parseJson") as timer:
+        fireInfo = json.loads(contents)
+        lats = numpy.array(fireInfo['fire_lats'], dtype=numpy.float64)
+        lngs = numpy.array(fireInfo['fire_lons'], dtype=numpy.float64)
+        timer.count(len(lats))
+        inBounds = (lats >= BOTTOM_LEFT_LAT) & (lats <= TOP_RIGHT_LAT) & (lngs >= BOTTOM_LEFT_LNG) & (lngs <= TOP_RIGHT_LNG)
+        pixelLocations = numpy.column_stack(coordinatesToPixels(lats[inBounds], lngs[inBounds], width, height))
+
+    if not os.path.exists(CACHE_DIRECTORY):
+        os.makedirs(CACHE_DIRECTORY)
+    for staleFile in glob.glob(CACHE_DIRECTORY + "fires-" + year + "-*.npy"):
+        os.remove(staleFile)
+    numpy.save(cacheFile, pixelLocations)
     return pixelLocations
 
-def processImage(image, fireLocations, buckets, counts):
-    currentX = 0
-    currentY = 0
-
-    data = []
-    while (currentX + SAMPLE_SIZE_X) <= REFERENCE_IMAGE_WIDTH_PX and (currentY + SAMPLE_SIZE_Y) <= REFERENCE_IMAGE_HEIGHT_PX:
-        colorVectorSum = [0, 0, 0]
-        for x in range(currentX, currentX + SAMPLE_SIZE_X):
-            for y in range(currentY, currentY + SAMPLE_SIZE_Y):
-                colorVectorSum[0] += image[x, y][0]
-                colorVectorSum[1] += image[x, y][1]
-                colorVectorSum[2] += image[x, y][2]
-        colorVectorAverage = [element / (SAMPLE_SIZE_X * SAMPLE_SIZE_Y) for element in colorVectorSum]
-        hue = round(colorsys.rgb_to_hsv(colorVectorAverage[0], colorVectorAverage[1], colorVectorAverage[2])[0], 2)
-        centerOfSampleX = currentX + SAMPLE_SIZE_X / 2
-        centerOfSampleY = currentY + SAMPLE_SIZE_Y / 2
-        minDistance = min([distanceInMeters(location, (centerOfSampleX, centerOfSampleY)) for location in fireLocations])
-
-        if hue not in buckets:
-            counts[hue] = 1
-            buckets[hue] = minDistance
-        else:
-            counts[hue] += 1
-            buckets[hue] += minDistance
-
-        currentX += 1
-
-        if (currentX + SAMPLE_SIZE_X) > REFERENCE_IMAGE_WIDTH_PX:
-            currentX = 0
-            currentY += 1
-
-def distanceInMeters(px1, px2):
-    deltaXMeters = (px1[0] - px2[0]) * METERS_PER_PIXEL_X
-    deltaYMeters = (px1[1] - px2[1]) * METERS_PER_PIXEL_Y
-    return math.sqrt(deltaXMeters ** 2 + deltaYMeters ** 2)
-
-def isLocationInBounds(coordinate):
-    if coordinate[0] >= BOTTOM_LEFT_LAT and coordinate[0] <= TOP_RIGHT_LAT and coordinate[1] >= BOTTOM_LEFT_LNG and coordinate[1] <= TOP_RIGHT_LNG:
-        return True
-    return False
-
-def process():
-    xVector = []
-    yVector = []
-
-    buckets = {}
-    counts = {}
-
-    for year in range(YEAR_START, YEAR_END):
-        print("Adding data from " + str(year))
-        processImage(openImage(str(year)), parseJson(str(year)), buckets, counts)
-
-    for key, value in buckets.items():
-        xVector += [key]
-        yVector += [value / counts[key]]
-
-    with open(AVERAGES_DATA_FILE, 'w') as file:
-        writer = csv.writer(file)
-        writer.writerows(zip(xVector, yVector))
-
+# Mean color of every SAMPLE_SIZE_X x SAMPLE_SIZE_Y window, computed with a separable box filter.
+# Entry [y, x] is the window whose top left pixel is (x, y).
+def windowMeans(image):
+    rows = image.shape[0] - SAMPLE_SIZE_Y + 1
+    columns = image.shape[1] - SAMPLE_SIZE_X + 1
+    columnSums = numpy.zeros((rows, image.shape[1], 3), dtype=numpy.uint32)
+    for offset in range(SAMPLE_SIZE_Y):
+        columnSums += image[offset:offset + rows]
+    windowSums = numpy.zeros((rows, columns, 3), dtype=numpy.uint32)
+    for offset in range(SAMPLE_SIZE_X):
+        windowSums += columnSums[:, offset:offset + columns]
+    return windowSums / (SAMPLE_SIZE_X * SAMPLE_SIZE_Y)
+
+# Vectorized colorsys.rgb_to_hsv hue, performing the same floating point operations
+def huesFromRgb(rgb):
+    r = rgb[..., 0]
+    g = rgb[..., 1]
+    b = rgb[..., 2]
+    maxc = numpy.maximum(numpy.maximum(r, g), b)
+    minc = numpy.minimum(numpy.minimum(r, g), b)
+    rangec = maxc - minc
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rc = (maxc - r) / rangec
+        gc = (maxc - g) / rangec
+        bc = (maxc - b) / rangec
+    hues = numpy.where(r == maxc, bc - gc, numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    hues = (hues / 6.0) % 1.0
+    hues[minc == maxc] = 0.0
+    return hues
+
+# Index of the multiple of 1 / scale nearest to every hue. When scale is a power of ten this is
+# round(hue, decimals), and round() works on the exact decimal value of the float, so hues that
+# land next to a rounding boundary are settled with it.
+def quantizeHues(hues, scale=HUE_SCALE):
+    scaled = hues * scale
+    bins = numpy.rint(scaled).astype(numpy.int64)
+    decimals = round(math.log10(scale)) if scale > 0 else 0
+    if 10 ** decimals != scale:
+        return bins
+    nearHalf = numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6
+    if nearHalf.any():
+        values, inverse = numpy.unique(hues[nearHalf], return_inverse=True)
+        exact = numpy.array([round(round(value, decimals) * scale) for value in values.tolist()])
+        bins[nearHalf] = exact[inverse.ravel()]
+    return bins
+
+# How window colors are binned. Each bin has an integer code, which is the hue bin alone or,
+# when saturation or value have more than one bin, the hue, saturation and value bins in
+# row major order.
+class FeatureBins:
+    def __init__(self, hueBins=HUE_BINS, saturationBins=SATURATION_BINS, valueBins=VALUE_BINS):
+        # The first and last hue bins sit on 0 and 1, so there must be two of them
+        if hueBins < 2:
+            raise ValueError("There must be at least 2 hue bins, not " + str(hueBins))
+        if saturationBins < 1 or valueBins < 1:
+            raise ValueError("There must be at least 1 saturation and value bin, not " + str(saturationBins) + " and " + str(valueBins))
+        self.hueBins = hueBins
+        self.saturationBins = saturationBins
+        self.valueBins = valueBins
+
+    def binCount(self):
+        return self.hueBins * self.saturationBins * self.valueBins
+
+    def isJoint(self):
+        return self.saturationBins > 1 or self.valueBins > 1
+
+    # Settings that change which bin a color falls in
+    def settings(self):
+        return (self.hueBins, self.saturationBins, self.valueBins)
+
+    # Bin code of every color along the last axis, with channels from 0 to 255
+    def codes(self, rgb):
+        hueBins = quantizeHues(huesFromRgb(rgb), self.hueBins - 1)
+        if not self.isJoint():
+            return hueBins
+        maxc = rgb.max(axis=-1)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            saturations = numpy.where(maxc > 0, (maxc - rgb.min(axis=-1)) / maxc, 0.0)
+        saturationBins = numpy.minimum((saturations * self.saturationBins).astype(numpy.int64), self.saturationBins - 1)
+        valueBins = numpy.minimum((maxc / 255 * self.valueBins).astype(numpy.int64), self.valueBins - 1)
+        return (hueBins * self.saturationBins + saturationBins) * self.valueBins + valueBins
+
+    def codeFromFeatures(self, hue, saturation=0.0, value=0.0):
+        hueBin = round(hue * (self.hueBins - 1))
+        return (hueBin * self.saturationBins + round(saturation * self.saturationBins)) * self.valueBins + round(value * self.valueBins)
+
+    # The hue of each bin and, for joint bins, the lower edges of its saturation and value
+    def features(self, code):
+        hueAndSaturation, valueBin = divmod(code, self.valueBins)
+        hueBin, saturationBin = divmod(hueAndSaturation, self.saturationBins)
+        hue = hueBin / (self.hueBins - 1)
+        if not self.isJoint():
+            return (hue,)
+        return (hue, saturationBin / self.saturationBins, valueBin / self.valueBins)
+
+# Distance in meters from the center of every window of a rows x columns grid of windows to its
+# nearest fire. The brute force search is kept as a reference to check the indexed lookup against.
+def nearestFireDistances(fireLocations, rows, columns, bruteForce=False):
+    imageShape = (rows + SAMPLE_SIZE_Y - 1, columns + SAMPLE_SIZE_X - 1)
+    return fireDistanceLookup(fireLocations, imageShape, bruteForce)(windowCenters(0, columns, SAMPLE_SIZE_X), windowCenters(0, rows, SAMPLE_SIZE_Y))
+
+# Maps (centersX, centersY) to the grid of distances to the nearest fire, on a raster of the
+# given (height, width)
+def fireDistanceLookup(fireLocations, imageShape, bruteForce=False):
+    metersPerPixelX, metersPerPixelY = metersPerPixel(imageShape[1], imageShape[0])
+    if bruteForce:
+        return partial(nearest.bruteForceDistances, fireLocations, metersPerPixelX=metersPerPixelX, metersPerPixelY=metersPerPixelY)
+    return nearest.FireIndex(fireLocations, metersPerPixelX, metersPerPixelY).distances
+
+def windowCenters(start, end, sampleSize):
+    return numpy.arange(start, end) + sampleSize / 2
+
+# Distance sums, window counts and first appearances of the feature bins of every window of
+# the image, merged into bins when they are given
+def processImage(image, fireLocations, bins=None, bruteForce=False, featureBins=None, year=0):
+    sampled = imagePartial(image, fireLocations, year, bruteForce, featureBins=featureBins)
+    return sampled if bins is None else bins.merge(sampled)
+
+# Samples the image one tile of windows at a time. Each tile is read with a halo of
+# SAMPLE_SIZE - 1 pixels so the windows along its edges are complete.
+def imagePartial(image, fireLocations, year, bruteForce=False, tileSize=TILE_SIZE_PX, featureBins=None):
+    featureBins = FeatureBins() if featureBins is None else featureBins
+    rows = image.shape[0] - SAMPLE_SIZE_Y + 1
+    columns = image.shape[1] - SAMPLE_SIZE_X + 1
+    fireDistances = fireDistanceLookup(fireLocations, image.shape, bruteForce)
+
+    bins = histogram.BinHistogram.empty(featureBins.binCount())
+    for top, left, bottom, right in tiles.tileBounds(rows, columns, tileSize):
+        tile = numpy.asarray(image[top:bottom + SAMPLE_SIZE_Y - 1, left:right + SAMPLE_SIZE_X - 1])
+        codes = featureBins.codes(windowMeans(tile)).ravel()
+        distances = fireDistances(windowCenters(left, right, SAMPLE_SIZE_X), windowCenters(top, bottom, SAMPLE_SIZE_Y)).ravel()
+
+        # Within a tile, row major order is the scan order, so the first index found locally
+        # is converted to the window's scan index over the whole image
+        def scanIndexes(firstIndexes):
+            tileRows, tileColumns = numpy.divmod(firstIndexes, right - left)
+            return year * FIRST_SEEN_YEAR_STRIDE + (top + tileRows) * columns + left + tileColumns
+
+        bins = bins.merge(histogram.BinHistogram.fromSamples(featureBins.binCount(), codes, distances, scanIndexes))
+    return bins
+
+def processYear(year, bruteForce=False, tileSize=TILE_SIZE_PX, featureBins=None):
+    print("Adding data from " + str(year))
+    image = openImageArray(str(year))
+    fireLocations = parseJson(str(year), image.shape)
+    with metrics.stage("sampleWindows") as timer:
+        timer.count((image.shape[0] - SAMPLE_SIZE_Y + 1) * (image.shape[1] - SAMPLE_SIZE_X + 1))
+        return imagePartial(image, fireLocations, year, bruteForce, tileSize, featureBins)
+
+# A stored partial is reused only while its image, fire list and sampling settings are unchanged.
+# The image digest covers its size, which the fires are projected and measured with.
+def partialKey(year, featureBins):
+    settings = str((featureBins.settings(), SAMPLE_SIZE_X, SAMPLE_SIZE_Y, BOTTOM_LEFT_LAT, BOTTOM_LEFT_LNG, TOP_RIGHT_LAT, TOP_RIGHT_LNG))
+    parts = [fileDigest(findImageFile(str(year))), fileDigest(findJsonFile(str(year))), settings]
+    return hashlib.sha1(",".join(parts).encode()).hexdigest()
+
+def partialFile(year):
+    return PARTIALS_DIRECTORY + str(year) + ".npz"
+
+def loadPartial(year, key):
+    if not os.path.exists(partialFile(year)):
+        return None
+    with numpy.load(partialFile(year)) as stored:
+        if str(stored['key']) != key:
+            return None
+        return histogram.BinHistogram.fromArrays({name: stored[name] for name in stored.files})
+
+def savePartial(year, key, bins):
+    if not os.path.exists(PARTIALS_DIRECTORY):
+        os.makedirs(PARTIALS_DIRECTORY)
+    numpy.savez(partialFile(year), key=key, **bins.toArrays())
+
+# Each year's partial is kept in PARTIALS_DIRECTORY, so only years that are new or whose inputs
+# changed are sampled again. With workers, those years are spread over a process pool. The
+# averages match a window by window scan up to the order the distances are summed in.
+def process(bruteForce=False, workers=None, tileSize=TILE_SIZE_PX, featureBins=None):
+    featureBins = FeatureBins() if featureBins is None else featureBins
+    years = range(YEAR_START, YEAR_END)
+    keys = {year: partialKey(year, featureBins) for year in years}
+    partials = {year: loadPartial(year, keys[year]) for year in years}
+    staleYears = [year for year in years if partials[year] is None]
+    print("Reusing stored data for " + str(len(years) - len(staleYears)) + " of " + str(len(years)) + " years")
+
+    # Partials are stored as soon as each year finishes, so an interrupted run keeps its progress
+    def storePartials(computed):
+        for year, bins in zip(staleYears, computed):
+            savePartial(year, keys[year], bins)
+            partials[year] = bins
+
+    yearProcessor = partial(processYear, bruteForce=bruteForce, tileSize=tileSize, featureBins=featureBins)
+    if workers is None:
+        storePartials(map(yearProcessor, staleYears))
+    else:
+        with Pool(workers) as pool:
+            storePartials(pool.imap(yearProcessor, staleYears))
+
+    with metrics.stage("mergePartials") as timer:
+        timer.count(len(years))
+        codes, sums, counts = reduce(histogram.BinHistogram.merge, [partials[year] for year in years]).seenBins()
+
+    # A header row holds the bins, then rows are the features of each bin followed by its average
+    # distance, in the order bins were first seen
+    features = [featureBins.features(code) for code in codes.tolist()]
+    averages = (sums / counts).tolist()
+    with metrics.stage("writeAverages") as timer:
+        timer.count(len(averages))
+        with open(AVERAGES_DATA_FILE, 'w') as file:
+            writer = csv.writer(file)
+            writer.writerow((AVERAGES_BINS_HEADER,) + featureBins.settings())
+            writer.writerows(binFeatures + (average,) for binFeatures, average in zip(features, averages))
+
+    xVector = [binFeatures[0] for binFeatures in features]
+    yVector = averages
     plot.scatter(xVector, yVector)
     plot.savefig(AVERAGES_GRAPH)
 
+# Compares the indexed nearest fire lookup against the brute force search for one year
+def checkNearest(year):
+    image = openImageArray(year)
+    fireLocations = parseJson(year, image.shape)
+    rows = image.shape[0] - SAMPLE_SIZE_Y + 1
+    columns = image.shape[1] - SAMPLE_SIZE_X + 1
+    indexed = nearestFireDistances(fireLocations, rows, columns)
+    bruteForce = nearestFireDistances(fireLocations, rows, columns, bruteForce=True)
+    print("Largest difference for " + year + ": " + str(numpy.abs(indexed - bruteForce).max()) + "m")
+
 # 1 when distance is 0, 0 when distance is 500000m
 def distanceToAlpha(distance):
     return -1 / 100000 * distance + 1
 
-def predict():
-    hueToAlpha = {}
-    dataFile = open(AVERAGES_DATA_FILE)
-    line = dataFile.readline()
-    while line:
-        pair = line.split(',')
-        if len(pair) != 2:
-            continue
-        hue = float(pair[0])
-        hueAlpha = distanceToAlpha(float(pair[1]))
-        hueToAlpha[hue] = hueAlpha
-        line = dataFile.readline()
-
-    bitmap = Image.new('RGBA', (REFERENCE_IMAGE_WIDTH_PX, REFERENCE_IMAGE_HEIGHT_PX), (0, 0, 0, 0))
-    output = bitmap.load()
-    pixels = openImage(str(YEAR_END))
-
-    for x in range(REFERENCE_IMAGE_WIDTH_PX):
-        for y in range(REFERENCE_IMAGE_HEIGHT_PX):
-            pixel = pixels[x, y]
-            hue = round(colorsys.rgb_to_hsv(pixel[0], pixel[1], pixel[2])[0], 2)
-            if hue in hueToAlpha and not (hue > OCEAN_EXCLUSION_RANGE[0] and hue <= OCEAN_EXCLUSION_RANGE[1]):
-                alpha = hueToAlpha[hue]
-            else:
-                alpha = 0
-            output[x, y] = (255, 0, 255, int(alpha * 255))
-
-    fires = parseJson(str(YEAR_END))[0:20]
-
-    background = Image.open(glob.glob('./images/*' + str(YEAR_END) + '*.png')[0]).convert('RGBA')
-    background.paste(bitmap, (0,0), bitmap)
-
-    draw = ImageDraw.Draw(background)
-
+# The bins the averages were written with. Averages without a header row were written before
+# the bins could be changed, with the default hue bins.
+def readFeatureBins(fileName=AVERAGES_DATA_FILE):
+    with open(fileName) as dataFile:
+        header = next(csv.reader(dataFile), [])
+    if not header or header[0] != AVERAGES_BINS_HEADER:
+        return FeatureBins()
+    return FeatureBins(*[int(value) for value in header[1:]])
+
+# Overlay alpha byte for every feature bin, looked up by indexing with bin codes. Bins missing
+# from the averages or with a hue inside the ocean range get no overlay. The bins are read from
+# the averages, and when featureBins is given it must match them.
+def loadHueAlphas(fileName=AVERAGES_DATA_FILE, featureBins=None):
+    storedBins = readFeatureBins(fileName)
+    if featureBins is not None and featureBins.settings() != storedBins.settings():
+        raise ValueError(
+            fileName + " was written with bins " + str(storedBins.settings()) +
+            " (hue, saturation, value), not " + str(featureBins.settings()))
+    featureBins = storedBins
+    columns = 4 if featureBins.isJoint() else 2
+    codes = []
+    alphas = []
+    with open(fileName) as dataFile:
+        for row in csv.reader(dataFile):
+            if not row or row[0] == AVERAGES_BINS_HEADER:
+                continue
+            if len(row) != columns:
+                raise ValueError(fileName + " has a row of " + str(len(row)) + " fields, expected " + str(columns))
+            hue = float(row[0])
+            if not (hue > OCEAN_EXCLUSION_RANGE[0] and hue <= OCEAN_EXCLUSION_RANGE[1]):
+                codes.append(featureBins.codeFromFeatures(*[float(value) for value in row[:-1]]))
+                alphas.append(distanceToAlpha(float(row[-1])))
+    # Pillow clamps channel values, so negative alphas for far away hues become 0
+    alphaBytes = numpy.clip(numpy.trunc(numpy.array(alphas) * 255), 0, 255).astype(numpy.uint8)
+    return histogram.BinTable(featureBins.binCount(), numpy.array(codes, dtype=numpy.int64), alphaBytes)
+
+# Overlay alpha for all 256^3 colors, indexed by (r << 16) | (g << 8) | b. Built once and
+# reused for every image rendered in the same run.
+def buildAlphaTable(hueAlphas, featureBins=None):
+    featureBins = FeatureBins() if featureBins is None else featureBins
+    table = numpy.empty(256 ** 3, dtype=numpy.uint8)
+    greenBlue = numpy.indices((256, 256), dtype=numpy.float64).reshape(2, -1).T
+    colors = numpy.empty((256 * 256, 3))
+    colors[:, 1:] = greenBlue
+    for red in range(256):
+        colors[:, 0] = red
+        table[red << 16:(red + 1) << 16] = hueAlphas[featureBins.codes(colors)]
+    return table
+
+def renderOverlay(image, alphaTable):
+    colorIndexes = (image[..., 0].astype(numpy.uint32) << 16) | (image[..., 1].astype(numpy.uint32) << 8) | image[..., 2]
+    overlay = numpy.empty(image.shape[:2] + (4,), dtype=numpy.uint8)
+    overlay[..., 0] = 255
+    overlay[..., 1] = 0
+    overlay[..., 2] = 255
+    overlay[..., 3] = alphaTable[colorIndexes]
+    return Image.fromarray(overlay, 'RGBA')
+
+# The circle marking each fire as (left, top, mask), drawn once on a canvas just big enough
+# for it. Pillow truncates coordinates toward zero, so canvases only move by whole pixels and
+# never past the image origin, which rasterizes each circle as if drawn on the full image.
+# Fire pixels count y up from the bottom, so they are flipped with the height of the image.
+def fireMarkers(fires, height):
+    markers = []
     for fire in fires:
-        draw.ellipse((fire[0] - 25, (REFERENCE_IMAGE_HEIGHT_PX - (fire[1] + 25)), fire[0] + 25, (REFERENCE_IMAGE_HEIGHT_PX - (fire[1] - 25))), fill=(199, 0, 57))
-    background.save(PREDICTION_IMAGE)
-
-if len(sys.argv) >= 2 and sys.argv[1] == "predict":
-    predict()
-elif len(sys.argv) >= 2 and sys.argv[1] == "process":
-    process()
+        box = (fire[0] - 25, (height - (fire[1] + 25)), fire[0] + 25, (height - (fire[1] - 25)))
+        left = max(0, math.floor(box[0]) - 1)
+        top = max(0, math.floor(box[1]) - 1)
+        mask = Image.new('L', (math.ceil(box[2]) - left + 2, math.ceil(box[3]) - top + 2), 0)
+        ImageDraw.Draw(mask).ellipse((box[0] - left, box[1] - top, box[2] - left, box[3] - top), fill=255)
+        markers.append((left, top, numpy.asarray(mask) > 0))
+    return markers
+
+# Blends the overlay onto the image and marks the year's first fires, one tile at a time.
+# Tiles are written straight into the output bitmap, which is never held in memory whole.
+def renderPrediction(year, alphaTable, outputFile, tileSize=TILE_SIZE_PX):
+    image = openImageArray(year)
+    height, width = image.shape[:2]
+    markers = fireMarkers(parseJson(year, image.shape)[0:20], height)
+
+    with metrics.stage("renderPixels") as timer, tiles.BmpWriter(outputFile, width, height) as writer:
+        timer.count(width * height)
+        for top, left, bottom, right in tiles.tileBounds(height, width, tileSize):
+            pixels = numpy.asarray(image[top:bottom, left:right])
+            bitmap = renderOverlay(pixels, alphaTable)
+            background = Image.fromarray(pixels, 'RGB').convert('RGBA')
+            background.paste(bitmap, (0,0), bitmap)
+            output = numpy.array(background)
+
+            for markerLeft, markerTop, mask in markers:
+                overlapLeft = max(left, markerLeft)
+                overlapTop = max(top, markerTop)
+                overlapRight = min(right, markerLeft + mask.shape[1])
+                overlapBottom = min(bottom, markerTop + mask.shape[0])
+                if overlapLeft >= overlapRight or overlapTop >= overlapBottom:
+                    continue
+                covered = mask[overlapTop - markerTop:overlapBottom - markerTop, overlapLeft - markerLeft:overlapRight - markerLeft]
+                output[overlapTop - top:overlapBottom - top, overlapLeft - left:overlapRight - left][covered] = (199, 0, 57, 255)
+            writer.writeTile(top, left, output)
+
+# Renders YEAR_END to PREDICTION_IMAGE, or each of the given years to its own image. Uses the
+# bins the averages were written with, which featureBins must match when it is given.
+def predict(years=None, tileSize=TILE_SIZE_PX, featureBins=None):
+    with metrics.stage("buildAlphaTable") as timer:
+        timer.count(256 ** 3)
+        hueAlphas = loadHueAlphas(AVERAGES_DATA_FILE, featureBins)
+        alphaTable = buildAlphaTable(hueAlphas, readFeatureBins(AVERAGES_DATA_FILE))
+    if not years:
+        renderPrediction(str(YEAR_END), alphaTable, PREDICTION_IMAGE, tileSize)
+        return
+    for year in years:
+        print("Rendering prediction for " + year)
+        renderPrediction(year, alphaTable, PREDICTION_IMAGE_FOR_YEAR.format(year), tileSize)
+
+OPTIONS_WITH_VALUES = ["--workers", "--tile-size", "--metrics", "--profile", "--hue-bins", "--saturation-bins", "--value-bins"]
+
+def optionValue(name, default=None):
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+# Command line arguments after the command that are neither options nor option values
+def positionalArguments():
+    arguments = []
+    index = 2
+    while index < len(sys.argv):
+        if sys.argv[index] in OPTIONS_WITH_VALUES:
+            index += 2
+            continue
+        if not sys.argv[index].startswith("--"):
+            arguments.append(sys.argv[index])
+        index += 1
+    return arguments
+
+# Worker processes import this module, so only run a command when executed directly
+if __name__ == "__main__":
+    tileSize = int(optionValue("--tile-size", TILE_SIZE_PX))
+    # predict reads the bins from the averages, and raises if it is given different ones
+    try:
+        featureBins = FeatureBins(
+            int(optionValue("--hue-bins", HUE_BINS)),
+            int(optionValue("--saturation-bins", SATURATION_BINS)),
+            int(optionValue("--value-bins", VALUE_BINS)))
+    except ValueError as error:
+        print(error)
+        exit(1)
+    binOptionsGiven = any(name in sys.argv for name in ["--hue-bins", "--saturation-bins", "--value-bins"])
+    # Stage timings go to the JSON lines file given with --metrics and are summarized at exit.
+    # --profile takes a comma separated list of stages to also run under cProfile.
+    profileStages = optionValue("--profile")
+    metrics.configure(optionValue("--metrics"), profileStages.split(",") if profileStages else (), PROFILE_DIRECTORY)
+    if len(sys.argv) >= 2 and sys.argv[1] == "predict":
+        with metrics.stage("predict"):
+            predict(positionalArguments(), tileSize, featureBins if binOptionsGiven else None)
+    elif len(sys.argv) >= 2 and sys.argv[1] == "process":
+        workers = optionValue("--workers")
+        with metrics.stage("process"):
+            process("--brute-force" in sys.argv, None if workers is None else int(workers), tileSize, featureBins)
+    elif len(sys.argv) >= 3 and sys.argv[1] == "check-nearest":
+        checkNearest(sys.argv[2])
@@ -0,0 +1,45 @@
+import numpy
+from scipy.spatial import cKDTree
+
+# Number of sample rows sent to the index per query, bounding the size of the query arrays
+QUERY_ROWS_PER_BATCH = 256
+
+def fireArray(fireLocations):
+    return numpy.array(fireLocations, dtype=numpy.float64).reshape(-1, 2)
+
+# Reference implementation: distance in meters from every (centersY[i], centersX[j]) sample
+# center to its nearest fire, checking every fire for every center.
+def bruteForceDistances(fireLocations, centersX, centersY, metersPerPixelX, metersPerPixelY):
+    fires = fireArray(fireLocations)
+    squaredDeltaX = ((fires[:, 0, None] - centersX) * metersPerPixelX) ** 2
+    squaredDeltaY = ((fires[:, 1, None] - centersY) * metersPerPixelY) ** 2
+    squaredDistances = numpy.empty((len(centersY), len(centersX)))
+    for row in range(len(centersY)):
+        squaredDistances[row] = (squaredDeltaX + squaredDeltaY[:, row, None]).min(axis=0)
+    return numpy.sqrt(squaredDistances)
+
+# KD-tree over a year's fire locations. Pixels are not square, so the tree is built in meters.
+class FireIndex:
+    def __init__(self, fireLocations, metersPerPixelX, metersPerPixelY):
+        self.fires = fireArray(fireLocations)
+        if len(self.fires) == 0:
+            raise Exception("Can't build a fire index without any fires")
+        self.metersPerPixelX = metersPerPixelX
+        self.metersPerPixelY = metersPerPixelY
+        self.tree = cKDTree(self.fires * [metersPerPixelX, metersPerPixelY])
+
+    # Same result as bruteForceDistances. The tree only picks the nearest fire, the distance
+    # to it is recomputed with the reference formula so both paths produce the same floats.
+    def distances(self, centersX, centersY):
+        distances = numpy.empty((len(centersY), len(centersX)))
+        centersXMeters = centersX * self.metersPerPixelX
+        for start in range(0, len(centersY), QUERY_ROWS_PER_BATCH):
+            batchY = centersY[start:start + QUERY_ROWS_PER_BATCH]
+            queries = numpy.empty((len(batchY), len(centersX), 2))
+            queries[:, :, 0] = centersXMeters
+            queries[:, :, 1] = (batchY * self.metersPerPixelY)[:, None]
+            _, nearest = self.tree.query(queries, workers=-1)
+            deltaX = (self.fires[nearest, 0] - centersX) * self.metersPerPixelX
+            deltaY = (self.fires[nearest, 1] - batchY[:, None]) * self.metersPerPixelY
+            distances[start:start + len(batchY)] = numpy.sqrt(deltaX ** 2 + deltaY ** 2)
+        return distances
@@ -0,0 +1,45 @@
+import numpy
+import struct
+
+BMP_FILE_HEADER_SIZE = 14
+BMP_INFO_HEADER_SIZE = 40
+BMP_BITS_PER_PIXEL = 32
+# 96 DPI, the resolution Pillow writes by default
+BMP_PIXELS_PER_METER = 3780
+
+# Yields (top, left, bottom, right) for the tiles covering a rows x columns grid, row by row
+def tileBounds(rows, columns, tileSize):
+    for top in range(0, rows, tileSize):
+        for left in range(0, columns, tileSize):
+            yield top, left, min(top + tileSize, rows), min(left + tileSize, columns)
+
+# Writes an RGBA image as a 32 bit BMP laid out the way Pillow saves one, a tile at a time,
+# so the full image never has to be held in memory.
+class BmpWriter:
+    def __init__(self, fileName, width, height):
+        self.width = width
+        self.height = height
+        self.stride = width * BMP_BITS_PER_PIXEL // 8
+        self.offset = BMP_FILE_HEADER_SIZE + BMP_INFO_HEADER_SIZE
+        imageSize = self.stride * height
+
+        self.file = open(fileName, 'wb')
+        self.file.write(b"BM" + struct.pack('<IIII', self.offset + imageSize, 0, self.offset, BMP_INFO_HEADER_SIZE))
+        self.file.write(struct.pack('<iiHHIIiiII', width, height, 1, BMP_BITS_PER_PIXEL, 0, imageSize, BMP_PIXELS_PER_METER, BMP_PIXELS_PER_METER, 0, 0))
+        self.file.truncate(self.offset + imageSize)
+
+    # Rows are stored bottom up in BGRA order
+    def writeTile(self, top, left, rgba):
+        bgra = numpy.ascontiguousarray(rgba[..., [2, 1, 0, 3]])
+        for row in range(bgra.shape[0]):
+            self.file.seek(self.offset + (self.height - 1 - (top + row)) * self.stride + left * 4)
+            self.file.write(bgra[row].tobytes())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
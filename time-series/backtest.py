@@ -0,0 +1,172 @@
+from main import CSV_OUTPUT_DIRECTORY, GRID_STEP, PROCESSED_CSV_FILENAME, PROFILE_DIRECTORY, YEAR_START, YEAR_END, option_values
+from learn import ACRES_BURNED_COLUMNS, FireTensor, NUMBER_OF_MONTHS_IN_YEAR, RegressionStatistics
+
+import metrics
+import numpy
+import os
+import pandas
+import sys
+import tempfile
+from multiprocessing import Pool
+
+BACKTEST_DIRECTORY = CSV_OUTPUT_DIRECTORY + "backtest/"
+
+# Years forecast after each origin, and the fewest years of history an origin is trained on.
+# With a single year the year trend can't be fitted, so origins need at least two.
+HORIZON_YEARS = 3
+MINIMUM_TRAINING_YEARS = 2
+LOWEST_MINIMUM_TRAINING_YEARS = 2
+
+# Sums every fold returns per cell and forecast year, from which the error metrics are computed.
+# Errors are predicted minus actual acres, and values counts the (month, cause) pairs scored.
+ERROR_SUMS = ['absolute_error', 'squared_error', 'error', 'actual_acres', 'predicted_acres', 'values']
+
+# History attached by each worker process. It is memory mapped from a file the parent writes
+# once, so the workers share its pages instead of each fold getting a copy.
+shared = {}
+
+def initialize_worker(history_file_name, shape, first_year_in_dataset):
+    # An empty file can't be mapped
+    if numpy.prod(shape) == 0:
+        shared['values'] = numpy.zeros(shape)
+    else:
+        shared['values'] = numpy.memmap(history_file_name, dtype=float, mode='r', shape=shape)
+    shared['first_year_in_dataset'] = first_year_in_dataset
+
+# Trains on every month up to the end of origin_year and forecasts the years after it, up to
+# horizon_years of them but not past last_year. Returns the error sums as an array of
+# (sums, cells, forecast years).
+def score_fold(origin_year, horizon_years, last_year):
+    values = shared['values']
+    first_year_in_dataset = shared['first_year_in_dataset']
+    with metrics.stage('backtest.fold') as timer:
+        training_months = (origin_year - first_year_in_dataset + 1) * NUMBER_OF_MONTHS_IN_YEAR
+        vectors = values[:, :training_months].transpose(0, 2, 1).reshape(-1, training_months)
+        predicted = RegressionStatistics.from_vectors(first_year_in_dataset, vectors) \
+            .forecast(origin_year + 1, min(origin_year + horizon_years, last_year))
+        actual = values[:, training_months:training_months + predicted.shape[1]] \
+            .transpose(0, 2, 1).reshape(predicted.shape)
+        timer.count(len(vectors))
+
+        # Sum over the causes and the months of each forecast year
+        years = predicted.shape[1] // NUMBER_OF_MONTHS_IN_YEAR
+        shape = (values.shape[0], len(ACRES_BURNED_COLUMNS), years, NUMBER_OF_MONTHS_IN_YEAR)
+        errors = predicted - actual
+        return numpy.stack([
+            numpy.abs(errors).reshape(shape).sum(axis=(1, 3)),
+            numpy.square(errors).reshape(shape).sum(axis=(1, 3)),
+            errors.reshape(shape).sum(axis=(1, 3)),
+            actual.reshape(shape).sum(axis=(1, 3)),
+            predicted.reshape(shape).sum(axis=(1, 3)),
+            numpy.full((values.shape[0], years), len(ACRES_BURNED_COLUMNS) * NUMBER_OF_MONTHS_IN_YEAR, dtype=float)])
+
+# Mean absolute error, root mean squared error, mean error and absolute error as a fraction of
+# the acres actually burned, from error sums along the first axis
+def error_metrics(sums):
+    absolute_error, squared_error, error, actual_acres, predicted_acres, values = sums
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'mae': absolute_error / values,
+            'rmse': numpy.sqrt(squared_error / values),
+            'bias': error / values,
+            'wape': numpy.where(actual_acres > 0, absolute_error / actual_acres, numpy.nan),
+            'actual_acres': actual_acres,
+            'predicted_acres': predicted_acres
+        }
+
+# Replays the predictor with rolling origins: for every year from first_year_in_dataset +
+# minimum_training_years - 1 to the year before last_year, it trains on the history up to that
+# year and scores the forecasts of the following years against the processed rows. The history
+# is parsed once into a temporary file the workers memory map, and the folds run in a pool of
+# workers processes, or one per CPU when workers is None.
+#
+# Writes cells.csv, the errors of every cell over all folds, and folds.csv, the errors of every
+# fold and forecast year over all cells, to output_directory, and returns the errors of each
+# forecast year over all folds and cells.
+def backtest(
+    input_file_name,
+    output_directory,
+    first_year_in_dataset,
+    last_year_in_dataset,
+    horizon_years=HORIZON_YEARS,
+    minimum_training_years=MINIMUM_TRAINING_YEARS,
+    workers=None,
+    grid_step=GRID_STEP):
+    if minimum_training_years < LOWEST_MINIMUM_TRAINING_YEARS:
+        raise ValueError('Origins must be trained on at least %d years' % LOWEST_MINIMUM_TRAINING_YEARS)
+    if horizon_years < 1:
+        raise ValueError('At least one year must be forecast after each origin')
+    with metrics.stage('backtest.load_rows') as timer:
+        frame = pandas.read_csv(input_file_name, float_precision='round_trip')
+        timer.count(len(frame))
+        fire_tensor = FireTensor.from_frame(frame, first_year_in_dataset, last_year_in_dataset, grid_step)
+    origins = list(range(first_year_in_dataset + minimum_training_years - 1, last_year_in_dataset))
+
+    descriptor, history_file_name = tempfile.mkstemp(prefix='backtest-', suffix='.dat')
+    os.close(descriptor)
+    try:
+        fire_tensor.values.tofile(history_file_name)
+        with metrics.stage('backtest.score_folds') as timer:
+            timer.count(len(origins))
+            with Pool(
+                workers,
+                initializer=initialize_worker,
+                initargs=(history_file_name, fire_tensor.values.shape, first_year_in_dataset)) as pool:
+                folds = pool.starmap(
+                    score_fold, [(origin, horizon_years, last_year_in_dataset) for origin in origins])
+    finally:
+        os.remove(history_file_name)
+
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    with metrics.stage('backtest.write_metrics') as timer:
+        latitudes, longitudes = fire_tensor.coordinates()
+        cells = pandas.DataFrame({'latitude': latitudes, 'longitude': longitudes})
+        cell_sums = sum(fold.sum(axis=2) for fold in folds)
+        for name, column in error_metrics(cell_sums).items():
+            cells[name] = column
+        cells.to_csv(os.path.join(output_directory, 'cells.csv'), index=False)
+
+        fold_frames = []
+        for origin, fold in zip(origins, folds):
+            fold_frame = pandas.DataFrame(error_metrics(fold.sum(axis=1)))
+            fold_frame.insert(0, 'horizon_years', numpy.arange(1, fold.shape[2] + 1))
+            fold_frame.insert(0, 'origin_year', origin)
+            fold_frames.append(fold_frame)
+        fold_frame = pandas.concat(fold_frames, ignore_index=True)
+        fold_frame.to_csv(os.path.join(output_directory, 'folds.csv'), index=False)
+        timer.count(len(cells) + len(fold_frame))
+
+    horizon_sums = numpy.zeros((len(ERROR_SUMS), horizon_years))
+    for fold in folds:
+        horizon_sums[:, :fold.shape[2]] += fold.sum(axis=1)
+    horizons = pandas.DataFrame(error_metrics(horizon_sums))
+    horizons.insert(0, 'horizon_years', numpy.arange(1, horizon_years + 1))
+    return horizons
+
+def option_value(name, default=None):
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+if __name__ == "__main__":
+    horizon_years = int(option_value("--horizon", HORIZON_YEARS))
+    minimum_training_years = int(option_value("--min-training-years", MINIMUM_TRAINING_YEARS))
+    workers = option_value("--workers")
+    if minimum_training_years < LOWEST_MINIMUM_TRAINING_YEARS or horizon_years < 1:
+        print("--min-training-years must be at least %d and --horizon at least 1" % LOWEST_MINIMUM_TRAINING_YEARS)
+        exit(1)
+    metrics.configure(option_value("--metrics"), option_values("--profile"), PROFILE_DIRECTORY)
+
+    print("Backtesting " + PROCESSED_CSV_FILENAME + "...")
+    horizons = backtest(
+        PROCESSED_CSV_FILENAME,
+        BACKTEST_DIRECTORY,
+        YEAR_START,
+        YEAR_END,
+        horizon_years,
+        minimum_training_years,
+        int(workers) if workers is not None else None,
+        GRID_STEP)
+    print(horizons.to_string(index=False))
+    print("Per cell and per fold errors written to " + BACKTEST_DIRECTORY)
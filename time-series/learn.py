@@ -1,179 +1,406 @@
 import csv
+import metrics
 import numpy
-from sklearn import linear_model
+import pandas
 
 NUMBER_OF_MONTHS_IN_YEAR = 12
+# Default cell size for callers that don't pass one. The pipeline and the tools built on it
+# pass main.GRID_STEP, which is the setting to change.
+GRID_STEP = 0.5
+ACRES_BURNED_COLUMNS = ['natural_acres_burned', 'human_acres_burned', 'unknown_acres_burned']
+PREDICTION_COLUMNS = ['latitude', 'longitude', 'year', 'month'] + ACRES_BURNED_COLUMNS
 
-class FireDate:
-    def __init__(self, year, month):
-        self.year = year
-        self.month = month
+# Cell months forecast at a time when streaming predictions, which bounds the memory they use
+# whatever the size of the grid and the forecast horizon
+PREDICTION_CHUNK_SIZE = 65536
 
-class FireData:
-    def __init__(self, first_year_in_dataset, last_year_in_dataset):
+# Years and months for indexes into monthly vectors that start in January of first_year
+def dates_from_indexes(first_year, indexes):
+    year_offsets, months = numpy.divmod(indexes, NUMBER_OF_MONTHS_IN_YEAR)
+    return first_year + year_offsets, months + 1
+
+# Acres burned per grid cell, month and cause, held in one (cells, months, causes) array.
+# Cells are numbered row by row from the south west corner of the globe, so sorted cell ids
+# order cells by latitude and then longitude.
+class FireTensor:
+    def __init__(self, cell_ids, first_year_in_dataset, last_year_in_dataset, grid_step=GRID_STEP):
+        self.cell_ids = cell_ids
         self.first_year_in_dataset = first_year_in_dataset
         self.last_year_in_dataset = last_year_in_dataset
-        self.natural_acres_burned_vector = self.create_vector()
-        self.human_acres_burned_vector = self.create_vector()
-        self.unknown_acres_burned_vector = self.create_vector()
-
-    def create_vector(self):
-        return [0] * (self.last_year_in_dataset - self.first_year_in_dataset + 1) * \
-            NUMBER_OF_MONTHS_IN_YEAR
-
-    def calculate_array_index(self, year, month):
-        year_offset = year - self.first_year_in_dataset
-        return year_offset * NUMBER_OF_MONTHS_IN_YEAR + (month - 1)
-
-    def date_from_index(self, index):
-        year_offset = int(index / NUMBER_OF_MONTHS_IN_YEAR)
-        month = index % NUMBER_OF_MONTHS_IN_YEAR
-        return FireDate(self.first_year_in_dataset + year_offset, month + 1)
-
-    def add_data_point_from_dictionary(self, dictionary):
-        month = int(dictionary['month'])
-        year = int(dictionary['year'])
-        latitude = float(dictionary['latitude'])
-        longitude = float(dictionary['longitude'])
-        natural_acres_burned = float(dictionary['natural_acres_burned'])
-        human_acres_burned = float(dictionary['human_acres_burned'])
-        unknown_acres_burned = float(dictionary['unknown_acres_burned'])
-        vector_index = self.calculate_array_index(year, month)
-        self.natural_acres_burned_vector[vector_index] = natural_acres_burned
-        self.human_acres_burned_vector[vector_index] = human_acres_burned
-        self.unknown_acres_burned_vector[vector_index] = unknown_acres_burned
-
-    def get_peak_month_from_vector(self, vector):
-        fires_per_month = [0] * NUMBER_OF_MONTHS_IN_YEAR
-        for month, number_of_fires in enumerate(vector):
-            fires_per_month[month % NUMBER_OF_MONTHS_IN_YEAR] += number_of_fires
-        return numpy.argmax(fires_per_month)
-
-class LocationKey:
-    def __init__(self, dictionary):
-        self.latitude = dictionary['latitude']
-        self.longitude = dictionary['longitude']
-
-    def __eq__(self, other):
-        return self.latitude == other.latitude and self.longitude == other.longitude
-
-    def __hash__(self):
-        return hash((self.latitude, self.longitude))
+        self.grid_step = grid_step
+        number_of_months = (last_year_in_dataset - first_year_in_dataset + 1) * NUMBER_OF_MONTHS_IN_YEAR
+        self.values = numpy.zeros((len(cell_ids), number_of_months, len(ACRES_BURNED_COLUMNS)))
 
-class Predictor:
-    class Prediction:
-        def __init__(
-            self,
-            latitude,
-            longitude,
-            year,
-            month,
-            natural_acres_burned,
-            human_acres_burned,
-            unknown_acres_burned
-            ):
-            self.latitude = latitude
-            self.longitude = longitude
-            self.year = year
-            self.month = month
-            self.natural_acres_burned = natural_acres_burned
-            self.human_acres_burned = human_acres_burned
-            self.unknown_acres_burned = unknown_acres_burned
-
-        def to_dictionary(self):
-            return {
-                'latitude': float(self.latitude),
-                'longitude': float(self.longitude),
-                'year': int(self.year),
-                'month': int(self.month),
-                'natural_acres_burned': float(self.natural_acres_burned),
-                'human_acres_burned': float(self.human_acres_burned),
-                'unknown_acres_burned': float(self.unknown_acres_burned)
-            }
+    @staticmethod
+    def grid_size(grid_step):
+        return int(round(180 / grid_step)), int(round(360 / grid_step))
+
+    # Coordinates must be cell corners of the grid. Rows written with another grid step would
+    # otherwise be merged into the wrong cells without any error.
+    @staticmethod
+    def cell_ids_from_coordinates(latitudes, longitudes, grid_step=GRID_STEP):
+        rows, columns = FireTensor.grid_size(grid_step)
+        scaled_latitudes = latitudes / grid_step
+        scaled_longitudes = longitudes / grid_step
+        if (numpy.abs(scaled_latitudes - numpy.round(scaled_latitudes)) > 1e-6).any() or \
+            (numpy.abs(scaled_longitudes - numpy.round(scaled_longitudes)) > 1e-6).any():
+            raise ValueError('Coordinates are not on a %g degree grid' % grid_step)
+        row = numpy.round(scaled_latitudes).astype(numpy.int64) + rows // 2
+        column = numpy.round(scaled_longitudes).astype(numpy.int64) + columns // 2
+        return row * columns + column
+
+    # Builds the tensor from rows of processed.csv. A sparse tensor only holds the cells that
+    # appear in the data, a dense one every cell in their bounding box.
+    @staticmethod
+    def from_frame(frame, first_year_in_dataset, last_year_in_dataset, grid_step=GRID_STEP, sparse=True):
+        frame = frame[(frame.year >= first_year_in_dataset) & (frame.year <= last_year_in_dataset)]
+        cell_ids = FireTensor.cell_ids_from_coordinates(
+            frame.latitude.to_numpy(dtype=float), frame.longitude.to_numpy(dtype=float), grid_step)
+        if sparse or len(cell_ids) == 0:
+            cells = numpy.unique(cell_ids)
+        else:
+            _, columns = FireTensor.grid_size(grid_step)
+            rows = numpy.arange(cell_ids.min() // columns, cell_ids.max() // columns + 1)
+            cell_columns = numpy.arange((cell_ids % columns).min(), (cell_ids % columns).max() + 1)
+            cells = (rows[:, None] * columns + cell_columns).ravel()
+
+        fire_tensor = FireTensor(cells, first_year_in_dataset, last_year_in_dataset, grid_step)
+        month_indexes = (frame.year.to_numpy(dtype=int) - first_year_in_dataset) * NUMBER_OF_MONTHS_IN_YEAR + \
+            frame.month.to_numpy(dtype=int) - 1
+        fire_tensor.values[fire_tensor.cell_index(cell_ids), month_indexes] = \
+            frame[ACRES_BURNED_COLUMNS].to_numpy(dtype=float)
+        return fire_tensor
+
+    # Position of each cell id in the tensor
+    def cell_index(self, cell_ids):
+        return numpy.searchsorted(self.cell_ids, cell_ids)
+
+    # Latitude and longitude of the south west corner of every cell, as the aggregator rounds them
+    @staticmethod
+    def coordinates_from_cell_ids(cell_ids, grid_step=GRID_STEP):
+        rows, columns = FireTensor.grid_size(grid_step)
+        row, column = numpy.divmod(cell_ids, columns)
+        return (row - rows // 2) * grid_step, (column - columns // 2) * grid_step
+
+    def coordinates(self):
+        return FireTensor.coordinates_from_cell_ids(self.cell_ids, self.grid_step)
+
+    def active_cells(self):
+        return self.values.any(axis=(1, 2))
+
+    # One monthly vector per (cell, cause)
+    def vectors(self, cells):
+        return self.values[cells].transpose(0, 2, 1).reshape(-1, self.values.shape[1])
+
+# Running sums from which the regression of every monthly vector is solved: the acres burned
+# in each calendar month, and the acres weighted by the number of years since the first year.
+# With the number of months seen, they give the normal equations for any peak month, so months
+# can be folded in one at a time without keeping the history. Months are always added in the
+# same order, so folding new months into saved statistics gives exactly the same sums, and the
+# same forecast, as building them from the whole history.
+class RegressionStatistics:
+    def __init__(self, first_year_in_dataset, number_of_vectors, cell_ids=None, grid_step=GRID_STEP):
+        self.first_year_in_dataset = first_year_in_dataset
+        self.number_of_months = 0
+        self.monthly_totals = numpy.zeros((number_of_vectors, NUMBER_OF_MONTHS_IN_YEAR))
+        self.year_moments = numpy.zeros(number_of_vectors)
+        # When the vectors belong to grid cells, vector i is cause i % 3 of cell_ids[i // 3]
+        self.cell_ids = cell_ids
+        self.grid_step = grid_step
+
+    @staticmethod
+    def from_vectors(first_year_in_dataset, vectors, cell_ids=None, grid_step=GRID_STEP):
+        statistics = RegressionStatistics(first_year_in_dataset, len(vectors), cell_ids, grid_step)
+        statistics.fold(vectors, 0)
+        return statistics
+
+    # Adds the columns of vectors as consecutive months starting at first_month_index
+    def fold(self, vectors, first_month_index):
+        for column in range(vectors.shape[1]):
+            year_offset, month = divmod(first_month_index + column, NUMBER_OF_MONTHS_IN_YEAR)
+            self.monthly_totals[:, month] += vectors[:, column]
+            self.year_moments += year_offset * vectors[:, column]
+        self.number_of_months = max(self.number_of_months, first_month_index + vectors.shape[1])
+
+    # Adds rows of processed.csv from the months that haven't been folded in yet, up to and
+    # including last_month of last_year. Cells seen for the first time get new vectors. Cells
+    # without a row in a month add nothing that month, which leaves the sums as adding a zero
+    # would. processed.csv has no rows for months without fires, so the months covered are
+    # advanced to last_month explicitly rather than to the last month with a row.
+    def fold_frame(self, frame, last_year, last_month):
+        last_month_index = (last_year - self.first_year_in_dataset) * NUMBER_OF_MONTHS_IN_YEAR + last_month - 1
+        month_indexes = (frame.year.to_numpy(dtype=int) - self.first_year_in_dataset) * NUMBER_OF_MONTHS_IN_YEAR + \
+            frame.month.to_numpy(dtype=int) - 1
+        if (month_indexes > last_month_index).any():
+            raise ValueError('Rows after %d-%02d can\'t be folded in' % (last_year, last_month))
+        frame = frame[month_indexes >= self.number_of_months]
+        month_indexes = month_indexes[month_indexes >= self.number_of_months]
+        self.number_of_months = max(self.number_of_months, last_month_index + 1)
+        if len(frame) == 0:
+            return
+        cell_ids = FireTensor.cell_ids_from_coordinates(
+            frame.latitude.to_numpy(dtype=float), frame.longitude.to_numpy(dtype=float), self.grid_step)
+        self.add_cells(cell_ids)
+
+        causes = len(ACRES_BURNED_COLUMNS)
+        rows = (numpy.searchsorted(self.cell_ids, cell_ids) * causes)[:, None] + numpy.arange(causes)
+        values = frame[ACRES_BURNED_COLUMNS].to_numpy(dtype=float)
+        for month_index in numpy.unique(month_indexes):
+            in_month = month_indexes == month_index
+            year_offset, month = divmod(int(month_index), NUMBER_OF_MONTHS_IN_YEAR)
+            self.monthly_totals[rows[in_month], month] += values[in_month]
+            self.year_moments[rows[in_month]] += year_offset * values[in_month]
+
+    def add_cells(self, cell_ids):
+        all_cell_ids = numpy.union1d(self.cell_ids, cell_ids)
+        if len(all_cell_ids) == len(self.cell_ids):
+            return
+        causes = len(ACRES_BURNED_COLUMNS)
+        rows = (numpy.searchsorted(all_cell_ids, self.cell_ids) * causes)[:, None] + numpy.arange(causes)
+        monthly_totals = numpy.zeros((len(all_cell_ids) * causes, NUMBER_OF_MONTHS_IN_YEAR))
+        year_moments = numpy.zeros(len(all_cell_ids) * causes)
+        monthly_totals[rows.ravel()] = self.monthly_totals
+        year_moments[rows.ravel()] = self.year_moments
+        self.cell_ids = all_cell_ids
+        self.monthly_totals = monthly_totals
+        self.year_moments = year_moments
+
+    # Fits a linear regression of acres burned against the year and the number of months from
+    # the peak month for every vector, or the vectors in rows, and returns its forecast for every
+    # month from January of start_year_to_predict to December of end_year_to_predict, floored at
+    # 0. Vectors only differ in their design matrix through the peak month, so the 2x2 normal
+    # equations of the centered features are solved once per peak month for all of its vectors
+    # together.
+    def forecast(self, start_year_to_predict, end_year_to_predict, rows=slice(None)):
+        monthly_totals = self.monthly_totals[rows]
+        year_moments = self.year_moments[rows]
+        years, months = numpy.divmod(numpy.arange(self.number_of_months), NUMBER_OF_MONTHS_IN_YEAR)
+        future_years, future_months = numpy.divmod(
+            numpy.arange((end_year_to_predict - start_year_to_predict + 1) * NUMBER_OF_MONTHS_IN_YEAR),
+            NUMBER_OF_MONTHS_IN_YEAR)
+        future_years = future_years + start_year_to_predict - self.first_year_in_dataset
+        vector_peak_months = numpy.argmax(monthly_totals, axis=1)
+        totals = monthly_totals.sum(axis=1)
+
+        predictions = numpy.zeros((len(totals), len(future_years)))
+        for peak_month in numpy.unique(vector_peak_months):
+            peak_rows = vector_peak_months == peak_month
+            # Calendar months count from 1 here and peak months from 0, as they always have
+            distances = numpy.abs(numpy.arange(1, NUMBER_OF_MONTHS_IN_YEAR + 1) - peak_month)
+            features = numpy.column_stack([years, distances[months]]).astype(float)
+            future_features = numpy.column_stack([future_years, distances[future_months]]).astype(float)
+
+            # Centering fits the intercept, as LinearRegression does
+            feature_means = features.mean(axis=0)
+            centered = features - feature_means
+            target_means = totals[peak_rows] / self.number_of_months
+            year_covariances = year_moments[peak_rows] - feature_means[0] * totals[peak_rows]
+            distance_covariances = (monthly_totals[peak_rows] * distances).sum(axis=1) - \
+                feature_means[1] * totals[peak_rows]
+
+            # The 2x2 system is solved element by element rather than with a matrix routine, whose
+            # rounding can depend on how many vectors are solved together, so a vector's forecast
+            # doesn't depend on which other vectors it is computed with
+            gram = centered.T @ centered
+            (year_variance, covariance), (_, distance_variance) = gram
+            determinant = year_variance * distance_variance - covariance * covariance
+            if determinant != 0:
+                year_coefficients = (distance_variance * year_covariances - covariance * distance_covariances) / determinant
+                distance_coefficients = (year_variance * distance_covariances - covariance * year_covariances) / determinant
+            else:
+                # A single year of history leaves the year column constant. The pseudo-inverse
+                # gives the minimum norm solution, as LinearRegression does, which puts no
+                # weight on the year.
+                (year_year, year_distance), (distance_year, distance_distance) = numpy.linalg.pinv(gram)
+                year_coefficients = year_year * year_covariances + year_distance * distance_covariances
+                distance_coefficients = distance_year * year_covariances + distance_distance * distance_covariances
+            future_centered = future_features - feature_means
+            predictions[peak_rows] = future_centered[:, 0] * year_coefficients[:, None] + \
+                future_centered[:, 1] * distance_coefficients[:, None] + target_means[:, None]
+        return numpy.maximum(0, predictions)
+
+    # Largest difference between forecast() and a least squares fit of each vector on its own, on
+    # random vectors with years_of_history years of history. One year of history checks that the
+    # singular system still gives a finite forecast.
+    @staticmethod
+    def check_forecast(years_of_history, number_of_vectors=100, forecast_years=3, seed=0):
+        first_year = 2000
+        random = numpy.random.RandomState(seed)
+        vectors = random.exponential(100, (number_of_vectors, years_of_history * NUMBER_OF_MONTHS_IN_YEAR))
+        vectors[random.random_sample(vectors.shape) < 0.7] = 0
+        forecast = RegressionStatistics.from_vectors(first_year, vectors).forecast(
+            first_year + years_of_history, first_year + years_of_history + forecast_years - 1)
 
+        years, months = numpy.divmod(numpy.arange(vectors.shape[1]), NUMBER_OF_MONTHS_IN_YEAR)
+        future_years, future_months = numpy.divmod(
+            numpy.arange(forecast_years * NUMBER_OF_MONTHS_IN_YEAR), NUMBER_OF_MONTHS_IN_YEAR)
+        future_years = future_years + years_of_history
+        reference = numpy.empty_like(forecast)
+        for row, vector in enumerate(vectors):
+            peak_month = numpy.argmax(vector.reshape(-1, NUMBER_OF_MONTHS_IN_YEAR).sum(axis=0))
+            distances = numpy.abs(numpy.arange(1, NUMBER_OF_MONTHS_IN_YEAR + 1) - peak_month)
+            features = numpy.column_stack([years, distances[months]]).astype(float)
+            feature_means = features.mean(axis=0)
+            coefficients = numpy.linalg.lstsq(features - feature_means, vector - vector.mean(), rcond=None)[0]
+            future_features = numpy.column_stack([future_years, distances[future_months]]) - feature_means
+            reference[row] = future_features @ coefficients + vector.mean()
+        return numpy.abs(forecast - numpy.maximum(0, reference)).max()
+
+    def save(self, file_name):
+        numpy.savez(
+            file_name,
+            first_year_in_dataset=self.first_year_in_dataset,
+            number_of_months=self.number_of_months,
+            monthly_totals=self.monthly_totals,
+            year_moments=self.year_moments,
+            cell_ids=self.cell_ids,
+            grid_step=self.grid_step)
+
+    @staticmethod
+    def load(file_name):
+        with numpy.load(file_name) as stored:
+            statistics = RegressionStatistics(
+                int(stored['first_year_in_dataset']),
+                len(stored['year_moments']),
+                stored['cell_ids'],
+                float(stored['grid_step']))
+            statistics.number_of_months = int(stored['number_of_months'])
+            statistics.monthly_totals = stored['monthly_totals']
+            statistics.year_moments = stored['year_moments']
+        return statistics
+
+    # Forecasts of every cell as frames of prediction rows, in cell order. Each frame covers as
+    # many cells as fit in chunk_size cell months, and only one is held in memory at once. At
+    # least one frame is generated, even when it is empty.
+    def predict(self, start_year_to_predict, end_year_to_predict, chunk_size=PREDICTION_CHUNK_SIZE):
+        causes = len(ACRES_BURNED_COLUMNS)
+        months = (end_year_to_predict - start_year_to_predict + 1) * NUMBER_OF_MONTHS_IN_YEAR
+        chunk_cells = max(1, chunk_size // months)
+        for first_cell in range(0, max(1, len(self.cell_ids)), chunk_cells):
+            last_cell = first_cell + chunk_cells
+            predicted_vectors = self.forecast(
+                start_year_to_predict, end_year_to_predict, slice(first_cell * causes, last_cell * causes))
+            yield prediction_frame(
+                self.cell_ids[first_cell:last_cell],
+                predicted_vectors.reshape(-1, causes, predicted_vectors.shape[1]),
+                start_year_to_predict,
+                self.grid_step)
+
+# Prediction rows, as columns, for every (cell, month) with a non zero forecast. predicted_vectors
+# holds the forecast of each cell and cause, starting in January of start_year_to_predict.
+def prediction_frame(cell_ids, predicted_vectors, start_year_to_predict, grid_step=GRID_STEP):
+    cells, indexes = numpy.nonzero(predicted_vectors.any(axis=1))
+    latitudes, longitudes = FireTensor.coordinates_from_cell_ids(cell_ids[cells], grid_step)
+    years, months = dates_from_indexes(start_year_to_predict, indexes)
+    frame = pandas.DataFrame({'latitude': latitudes, 'longitude': longitudes, 'year': years, 'month': months})
+    acres_burned = predicted_vectors[cells, :, indexes]
+    for cause, column in enumerate(ACRES_BURNED_COLUMNS):
+        frame[column] = acres_burned[:, cause]
+    return frame
+
+class Predictor:
     def __init__(
         self,
         first_year_in_dataset,
         last_year_in_dataset,
         start_year_to_predict,
-        end_year_to_predict
+        end_year_to_predict,
+        sparse=True,
+        grid_step=GRID_STEP
         ):
         self.first_year_in_dataset = first_year_in_dataset
         self.last_year_in_dataset = last_year_in_dataset
         self.start_year_to_predict = start_year_to_predict
         self.end_year_to_predict = end_year_to_predict
-        self.locations_to_fire_data = dict()
-
-    def add_data_point(self, dictionary):
-        location_key = LocationKey(dictionary)
-        if location_key not in self.locations_to_fire_data:
-            self.locations_to_fire_data[location_key] = \
-                FireData(self.first_year_in_dataset, self.last_year_in_dataset)
-        self.locations_to_fire_data[location_key].add_data_point_from_dictionary(dictionary)
-
-    def predict(self):
-        predictions = []
-        for location in self.locations_to_fire_data:
-            self.predict_location(predictions, location)
-        return [prediction.to_dictionary() for prediction in predictions]
-
-    def predict_location(self, predictions, location):
-        fire_data = self.locations_to_fire_data[location]
-        predicted_natural_acres_burned_vector = \
-            self.predict_vector(fire_data, fire_data.natural_acres_burned_vector)
-        predicted_human_acres_burned_vector = \
-            self.predict_vector(fire_data, fire_data.human_acres_burned_vector)
-        predicted_unknown_acres_burned_vector = \
-            self.predict_vector(fire_data, fire_data.unknown_acres_burned_vector)
-
-        predicted_fire_data = FireData(self.start_year_to_predict, self.end_year_to_predict)
-
-        for index in range(len(predicted_natural_acres_burned_vector)):
-            date = predicted_fire_data.date_from_index(index)
-            natural_acres_burned = predicted_natural_acres_burned_vector[index]
-            human_acres_burned = predicted_human_acres_burned_vector[index]
-            unknown_acres_burned = predicted_unknown_acres_burned_vector[index]
-
-            if natural_acres_burned == 0 and human_acres_burned == 0 and unknown_acres_burned == 0:
-                continue
-
-            predictions.append(Predictor.Prediction(
-                location.latitude,
-                location.longitude,
-                date.year,
-                date.month,
-                natural_acres_burned,
-                human_acres_burned,
-                unknown_acres_burned))
-
-    def predict_vector(self, fire_data, vector):
-        features = []
-        prediction_vector = []
-        peak_month = fire_data.get_peak_month_from_vector(vector)
-
-        for index in range(len(vector)):
-            date = fire_data.date_from_index(index)
-            number_of_months_from_peak = abs(date.month - peak_month)
-            features.append([date.year, number_of_months_from_peak])
-        
-        regressor = linear_model.LinearRegression()
-        regressor.fit(features, vector)
-
-        for year in range(self.start_year_to_predict, self.end_year_to_predict + 1):
-            for month in range(1, NUMBER_OF_MONTHS_IN_YEAR + 1):
-                number_of_months_from_peak = abs(month - peak_month)
-                prediction = max(0, regressor.predict([[year, number_of_months_from_peak]])[0])
-                prediction_vector.append(prediction)
-        return prediction_vector
-
-def write_prediction_rows(rows, file_name):
-  if len(rows) == 0:
-    return
-  keys = rows[0].keys()
-  with open(file_name, 'w') as output_file:
-      dict_writer = csv.DictWriter(output_file, keys)
-      dict_writer.writeheader()
-      dict_writer.writerows(rows)
+        self.sparse = sparse
+        self.grid_step = grid_step
+        self.fire_tensor = FireTensor(
+            numpy.zeros(0, dtype=numpy.int64), first_year_in_dataset, last_year_in_dataset, grid_step)
+
+    def add_data_points(self, frame):
+        self.fire_tensor = FireTensor.from_frame(
+            frame, self.first_year_in_dataset, self.last_year_in_dataset, self.grid_step, self.sparse)
+
+    # Statistics of every cell that burned at least once, in cell order
+    def statistics(self):
+        cells = numpy.flatnonzero(self.fire_tensor.active_cells())
+        return RegressionStatistics.from_vectors(
+            self.first_year_in_dataset,
+            self.fire_tensor.vectors(cells),
+            self.fire_tensor.cell_ids[cells],
+            self.grid_step)
+
+    # Frames of predictions for every cell that burned at least once, in cell order. They are
+    # generated as they are read, so the forecasts are computed while they are written.
+    def predict(self, statistics=None):
+        if statistics is None:
+            with metrics.stage('predict.fit_cells') as timer:
+                statistics = self.statistics()
+                timer.count(len(statistics.cell_ids))
+        return statistics.predict(self.start_year_to_predict, self.end_year_to_predict)
+
+# Prediction files with these extensions are written in a binary columnar format instead of CSV
+ARROW_EXTENSIONS = ('.arrow', '.feather')
+COLUMNAR_EXTENSIONS = ('.parquet',) + ARROW_EXTENSIONS
+
+# Writes frames of prediction rows to a CSV file, with numbers formatted as Python prints them
+class CsvPredictionWriter:
+    def __init__(self, file_name):
+        self.output_file = open(file_name, 'w')
+        self.writer = csv.writer(self.output_file)
+        self.writer.writerow(PREDICTION_COLUMNS)
+
+    def write(self, frame):
+        self.writer.writerows(zip(*[frame[column].tolist() for column in PREDICTION_COLUMNS]))
+
+    def close(self):
+        self.output_file.close()
+
+# Writes frames of prediction rows to a Parquet file, or an Arrow IPC file when the name ends in
+# .arrow or .feather, one row group or record batch per frame. Needs pyarrow, which is only
+# imported when one of these formats is asked for.
+class ArrowPredictionWriter:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.writer = None
+
+    def write(self, frame):
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+        table = pyarrow.Table.from_pandas(frame[PREDICTION_COLUMNS], preserve_index=False)
+        if self.writer is None:
+            if self.file_name.endswith(ARROW_EXTENSIONS):
+                self.writer = pyarrow.ipc.new_file(self.file_name, table.schema)
+            else:
+                self.writer = pyarrow.parquet.ParquetWriter(self.file_name, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def prediction_writer(file_name):
+    if file_name.endswith(COLUMNAR_EXTENSIONS):
+        return ArrowPredictionWriter(file_name)
+    return CsvPredictionWriter(file_name)
+
+# Writes every frame to each of the files as it is generated, in the format given by the file's
+# extension, and returns the number of rows written
+def write_predictions(frames, file_names):
+    writers = []
+    try:
+        for file_name in file_names:
+            writers.append(prediction_writer(file_name))
+        rows = 0
+        for frame in frames:
+            for writer in writers:
+                writer.write(frame)
+            rows += len(frame)
+        return rows
+    finally:
+        for writer in writers:
+            writer.close()
 
 def predict(
     input_file_name,
@@ -181,15 +408,53 @@ def predict(
     start_year_in_dataset,
     end_year_in_dataset,
     start_year_to_predict,
-    end_year_to_predict):
+    end_year_to_predict,
+    sparse=True,
+    grid_step=GRID_STEP,
+    statistics_file_name=None,
+    columnar_file_name=None):
     predictor = Predictor(
         start_year_in_dataset,
         end_year_in_dataset,
         start_year_to_predict,
-        end_year_to_predict
+        end_year_to_predict,
+        sparse,
+        grid_step
         )
-    with open(input_file_name) as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            predictor.add_data_point(row)
-        write_prediction_rows(predictor.predict(), output_file_name)
+    with metrics.stage('predict.load_rows') as timer:
+        frame = pandas.read_csv(input_file_name, float_precision='round_trip')
+        timer.count(len(frame))
+        predictor.add_data_points(frame)
+    with metrics.stage('predict.fit_cells') as timer:
+        statistics = predictor.statistics()
+        timer.count(len(statistics.cell_ids))
+    if statistics_file_name is not None:
+        statistics.save(statistics_file_name)
+    with metrics.stage('predict.write_rows') as timer:
+        timer.count(write_predictions(
+            predictor.predict(statistics),
+            [file_name for file_name in [output_file_name, columnar_file_name] if file_name is not None]))
+
+# Folds the months of input_file_name that come after the saved statistics into them, up to
+# and including last_month of last_year, saves them again, and writes forecasts from the
+# statistics alone. Rows from months already in the statistics are ignored, so the input only
+# needs to hold the new months.
+def update(
+    statistics_file_name,
+    input_file_name,
+    output_file_name,
+    last_year,
+    last_month,
+    start_year_to_predict,
+    end_year_to_predict,
+    columnar_file_name=None):
+    statistics = RegressionStatistics.load(statistics_file_name)
+    with metrics.stage('update.fold_rows') as timer:
+        frame = pandas.read_csv(input_file_name, float_precision='round_trip')
+        timer.count(len(frame))
+        statistics.fold_frame(frame, last_year, last_month)
+    statistics.save(statistics_file_name)
+    with metrics.stage('predict.write_rows') as timer:
+        timer.count(write_predictions(
+            statistics.predict(start_year_to_predict, end_year_to_predict),
+            [file_name for file_name in [output_file_name, columnar_file_name] if file_name is not None]))
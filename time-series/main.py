@@ -1,31 +1,41 @@
+import os
+import sys
+
+# Stage metrics are shared with the terrain pipeline in ../common. backtest.py and serve.py import
+# this module before any other, so they find them too.
+COMMON_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common")
+if COMMON_DIRECTORY not in sys.path:
+    sys.path.append(COMMON_DIRECTORY)
+
 from process import process_csvs
-from learn import predict
+from learn import RegressionStatistics, predict, update
 from merge import merge_for_render
+from pyramid import build_pyramid
+from stages import Stage, StageRunner
 
-import os
+import metrics
 import shutil
-import sys
 
 CSV_OUTPUT_DIRECTORY = "csv_outputs/"
 PROCESSED_CSV_FILENAME = CSV_OUTPUT_DIRECTORY + "processed.csv"
 PREDICT_CSV_FILENAME = CSV_OUTPUT_DIRECTORY + "predict.csv"
+PREDICT_PARQUET_FILENAME = CSV_OUTPUT_DIRECTORY + "predict.parquet"
+STATISTICS_FILENAME = CSV_OUTPUT_DIRECTORY + "statistics.npz"
 RENDER_DIRECTORY = "render/public/csv/"
-
-if len(sys.argv) >= 2 and sys.argv[1] == "clean":
-    print("Cleaning output directories...")
-    if os.path.exists(CSV_OUTPUT_DIRECTORY):
-        shutil.rmtree(CSV_OUTPUT_DIRECTORY)
-    if os.path.exists(RENDER_DIRECTORY):
-        shutil.rmtree(RENDER_DIRECTORY)
-    exit()
+PYRAMID_DIRECTORY = CSV_OUTPUT_DIRECTORY + "pyramid/"
+STAGES_STATE_FILENAME = CSV_OUTPUT_DIRECTORY + "stages.json"
+PROFILE_DIRECTORY = CSV_OUTPUT_DIRECTORY + "profiles/"
 
 YEAR_START = 1992
 YEAR_END = 2015
 PREDICT_START = 2016
 PREDICT_END = 2024
 
-if not os.path.exists(CSV_OUTPUT_DIRECTORY):
-    os.makedirs(CSV_OUTPUT_DIRECTORY)
+# Size of the grid cells in degrees, and the number of levels in the pyramid of coarser grids
+# built on top of it, each with twice the step of the one below. Every stage, serve.py and
+# backtest.py read the grid step from here.
+GRID_STEP = 0.5
+PYRAMID_LEVELS = 4
 
 input_csvs = [
     'data/us_fires_1.csv',
@@ -37,23 +47,130 @@ input_csvs = [
     'data/us_fires_7.csv'
 ]
 
-print("Processing input CSVs...")
-process_csvs(input_csvs, PROCESSED_CSV_FILENAME)
-print("Running prediction...")
-predict(
-   PROCESSED_CSV_FILENAME,
-   PREDICT_CSV_FILENAME,
-	YEAR_START,
-	YEAR_END,
-	PREDICT_START,
-	PREDICT_END
-)
-if not os.path.exists(RENDER_DIRECTORY):
-	os.makedirs(RENDER_DIRECTORY)
-print("Merging CSVs for render...")
-merge_for_render(
-    PROCESSED_CSV_FILENAME,
-    PREDICT_CSV_FILENAME,
-    RENDER_DIRECTORY,
-    YEAR_START,
-    PREDICT_END)
+def option_values(name):
+    return [sys.argv[index + 1] for index, argument in enumerate(sys.argv[:-1]) if argument == name]
+
+def run_process(workers):
+    print("Processing input CSVs...")
+    process_csvs(input_csvs, PROCESSED_CSV_FILENAME, workers=workers, grid_step=GRID_STEP)
+
+# Predictions are also written to predict.parquet when parquet is set, which needs pyarrow
+def run_predict(parquet):
+    print("Running prediction...")
+    predict(
+        PROCESSED_CSV_FILENAME,
+        PREDICT_CSV_FILENAME,
+        YEAR_START,
+        YEAR_END,
+        PREDICT_START,
+        PREDICT_END,
+        grid_step=GRID_STEP,
+        statistics_file_name=STATISTICS_FILENAME,
+        columnar_file_name=PREDICT_PARQUET_FILENAME if parquet else None
+    )
+
+def run_update(input_csv, last_year, last_month, parquet):
+    print("Updating prediction with " + input_csv + " through " + "%d-%02d" % (last_year, last_month) + "...")
+    update(
+        STATISTICS_FILENAME,
+        input_csv,
+        PREDICT_CSV_FILENAME,
+        last_year,
+        last_month,
+        PREDICT_START,
+        PREDICT_END,
+        columnar_file_name=PREDICT_PARQUET_FILENAME if parquet else None)
+
+def run_merge():
+    if not os.path.exists(RENDER_DIRECTORY):
+        os.makedirs(RENDER_DIRECTORY)
+    print("Merging CSVs for render...")
+    merge_for_render(
+        PROCESSED_CSV_FILENAME,
+        PREDICT_CSV_FILENAME,
+        RENDER_DIRECTORY,
+        YEAR_START,
+        PREDICT_END)
+
+def run_pyramid():
+    print("Building grid pyramid...")
+    build_pyramid(PROCESSED_CSV_FILENAME, PYRAMID_DIRECTORY, "processed", GRID_STEP, PYRAMID_LEVELS)
+    build_pyramid(PREDICT_CSV_FILENAME, PYRAMID_DIRECTORY, "predict", GRID_STEP, PYRAMID_LEVELS)
+
+def pipeline_stages(workers, parquet=False):
+    return [
+        Stage('process', lambda: run_process(workers), input_csvs, [PROCESSED_CSV_FILENAME], [GRID_STEP]),
+        Stage(
+            'predict',
+            lambda: run_predict(parquet),
+            [PROCESSED_CSV_FILENAME],
+            [PREDICT_CSV_FILENAME, STATISTICS_FILENAME] + ([PREDICT_PARQUET_FILENAME] if parquet else []),
+            [YEAR_START, YEAR_END, PREDICT_START, PREDICT_END, GRID_STEP]),
+        Stage(
+            'merge',
+            run_merge,
+            [PROCESSED_CSV_FILENAME, PREDICT_CSV_FILENAME],
+            [RENDER_DIRECTORY],
+            [YEAR_START, PREDICT_END]),
+        Stage(
+            'pyramid',
+            run_pyramid,
+            [PROCESSED_CSV_FILENAME, PREDICT_CSV_FILENAME],
+            [PYRAMID_DIRECTORY],
+            [GRID_STEP, PYRAMID_LEVELS])
+    ]
+
+# Worker processes import this module, so only run the pipeline when executed directly
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "clean":
+        print("Cleaning output directories...")
+        if os.path.exists(CSV_OUTPUT_DIRECTORY):
+            shutil.rmtree(CSV_OUTPUT_DIRECTORY)
+        if os.path.exists(RENDER_DIRECTORY):
+            shutil.rmtree(RENDER_DIRECTORY)
+        exit()
+
+    # Compares the batched forecast against a least squares fit of each vector on its own
+    if len(sys.argv) >= 2 and sys.argv[1] == "check-forecast":
+        for years_of_history in [1, 2, 5]:
+            print("Largest difference with %d year(s) of history: %g acres" % (
+                years_of_history, RegressionStatistics.check_forecast(years_of_history)))
+        exit()
+
+    # Stage timings go to the JSON lines file given with --metrics and are summarized at exit.
+    # --profile <stage> also runs a stage, or a step such as predict.fit_cells, under cProfile.
+    metrics_file = option_values("--metrics")
+    metrics.configure(metrics_file[0] if metrics_file else None, option_values("--profile"), PROFILE_DIRECTORY)
+
+    # --parquet also writes the predictions to predict.parquet
+    parquet = "--parquet" in sys.argv
+
+    # Folds new months up to the YYYY-MM given, as rows in the format of processed.csv, into the
+    # statistics saved by the last prediction and rewrites predict.csv from them without
+    # refitting the whole history. The last month is given because quiet months have no rows.
+    if len(sys.argv) >= 2 and sys.argv[1] == "update":
+        if len(sys.argv) < 4:
+            print("Usage: python main.py update <csv> <last YYYY-MM>")
+            exit(1)
+        last_year, last_month = [int(part) for part in sys.argv[3].split("-")]
+        with metrics.stage("update"):
+            run_update(sys.argv[2], last_year, last_month, parquet)
+        # The updated files become the predict stage's outputs, so the next run keeps them
+        # instead of refitting from processed.csv, and reruns the stages that read them
+        predict_stage = next(stage for stage in pipeline_stages(None, parquet) if stage.name == 'predict')
+        StageRunner(STAGES_STATE_FILENAME).record(predict_stage)
+        exit()
+
+    # Input CSVs are bucketed in a pool of this many processes when given
+    workers = int(sys.argv[sys.argv.index("--workers") + 1]) if "--workers" in sys.argv else None
+
+    if not os.path.exists(CSV_OUTPUT_DIRECTORY):
+        os.makedirs(CSV_OUTPUT_DIRECTORY)
+
+    # Stages whose inputs, parameters and outputs haven't changed since their last run are
+    # skipped. --force <stage> reruns a stage anyway and --only <stage> runs just that stage.
+    only = option_values("--only")
+    StageRunner(STAGES_STATE_FILENAME).run(
+        pipeline_stages(workers, parquet),
+        force=option_values("--force"),
+        only=only[0] if only else None)
@@ -1,17 +1,91 @@
+import json
+import metrics
+import numpy
 import os
 import pandas
+from concurrent.futures import ThreadPoolExecutor
 
+NUMBER_OF_MONTHS_IN_YEAR = 12
+MANIFEST_FILE_NAME = "manifest.json"
+WRITER_THREADS = 8
+
+def month_file_name(year, month):
+	return str(month) + str(year) + ".csv"
+
+def year_file_name(year):
+	return "year" + str(year) + ".csv"
+
+def write_file(file_name, text):
+	with open(file_name, 'w', newline='') as output_file:
+		output_file.write(text)
+
+# Writes the month files and the year file of one year from the formatted lines of its months,
+# which start at partition first_partition, and returns where each month's rows sit in the
+# year file. Only one month's text is built at a time.
+def write_year(output_directory, header, lines, row_counts, row_ends, year, first_partition):
+	months = {}
+	offset = len(header.encode())
+	with open(output_directory + year_file_name(year), 'w', newline='') as year_file:
+		year_file.write(header)
+		for month in range(1, NUMBER_OF_MONTHS_IN_YEAR + 1):
+			partition = first_partition + month - 1
+			body = ''.join(lines[row_ends[partition] - row_counts[partition]:row_ends[partition]])
+			write_file(output_directory + month_file_name(year, month), header + body)
+			year_file.write(body)
+			body_bytes = len(body.encode())
+			months[str(month)] = {
+				'offset': offset,
+				'bytes': body_bytes,
+				'rows': int(row_counts[partition])
+			}
+			offset += body_bytes
+	return months
+
+# Writes one CSV per year between start_year and end_year holding its months back to back, plus
+# one CSV per month. render/ only fetches the year files, and the month files are kept for
+# clients of the earlier one file per month layout. The combined rows are sorted by month once
+# and formatted once, then the years are written on a thread pool, each building its files
+# from its slice of the formatted lines as it writes them. The manifest records where each
+# month's rows sit in its year's file, so a whole year can be fetched with a single request.
 def merge_for_render(
 	historical_csv,
 	prediction_csv,
 	output_directory,
 	start_year,
-	end_year
+	end_year,
+	threads=WRITER_THREADS
 	):
 	combined_csv = pandas.concat(
 	[pandas.read_csv(file) for file in [historical_csv, prediction_csv]])
 
-	for year in range(start_year, end_year + 1):
-		for month in range(1, 12 + 1):
-			combined_csv[(combined_csv.year == year) & (combined_csv.month == month)] \
-				.to_csv(output_directory + str(month) + str(year) + ".csv", index=False)
+	number_of_partitions = (end_year - start_year + 1) * NUMBER_OF_MONTHS_IN_YEAR
+	partitions = (combined_csv.year.to_numpy() - start_year) * NUMBER_OF_MONTHS_IN_YEAR + \
+		combined_csv.month.to_numpy() - 1
+	in_range = (partitions >= 0) & (partitions < number_of_partitions)
+	partitions = partitions[in_range]
+	# A stable sort keeps rows in their original order within each month
+	order = numpy.argsort(partitions, kind='mergesort')
+	row_counts = numpy.bincount(partitions, minlength=number_of_partitions)
+	row_ends = numpy.cumsum(row_counts)
+
+	with metrics.stage('merge.format_rows') as timer:
+		timer.count(len(order))
+		header = combined_csv.iloc[:0].to_csv(index=False)
+		lines = combined_csv[in_range].iloc[order].to_csv(index=False, header=False).splitlines(True)
+
+	manifest = {'header_bytes': len(header.encode()), 'years': {}}
+	years = range(start_year, end_year + 1)
+	with metrics.stage('merge.write_partitions') as timer, ThreadPoolExecutor(threads) as executor:
+		timer.count(len(years) * (NUMBER_OF_MONTHS_IN_YEAR + 1) + 1)
+		results = [executor.submit(
+			write_year,
+			output_directory,
+			header,
+			lines,
+			row_counts,
+			row_ends,
+			year,
+			(year - start_year) * NUMBER_OF_MONTHS_IN_YEAR) for year in years]
+		for year, result in zip(years, results):
+			manifest['years'][str(year)] = {'file': year_file_name(year), 'months': result.result()}
+		write_file(output_directory + MANIFEST_FILE_NAME, json.dumps(manifest, indent=2))
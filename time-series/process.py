@@ -1,8 +1,20 @@
+from learn import GRID_STEP
+
 import csv
+import metrics
 import numpy
 import os
+import pandas
 from dateutil.parser import parse
 from enum import Enum
+from functools import partial
+from multiprocessing import Pool
+
+# Columns of the input CSVs that are used, and the format of their dates. Dates that don't
+# match DATE_FORMAT fall back to dateutil.
+FIRE_COLUMNS = ['latitude', 'longitude', 'discovery_date', 'cont_date', 'stat_cause_code', 'fire_size']
+DATE_FORMAT = '%Y-%m-%d'
+CHUNK_SIZE = 200000
 
 # The cause of the fire
 class Cause(Enum):
@@ -68,11 +80,18 @@ class Aggregator:
             else:
                 self.unknown_acres_burned += acres_burned
 
-    def __init__(self):
+        def merge(self, other):
+            self.natural_acres_burned += other.natural_acres_burned
+            self.human_acres_burned += other.human_acres_burned
+            self.unknown_acres_burned += other.unknown_acres_burned
+
+    def __init__(self, grid_step=GRID_STEP):
         self.buckets = dict()
+        self.grid_step = grid_step
 
-    # Rounds the coordinates to the nearest 0.5 degrees
-    def round_coordinate(self, coordinate, step_size=0.5):
+    # Rounds the coordinates down to a multiple of the grid step
+    def round_coordinate(self, coordinate, step_size=None):
+        step_size = self.grid_step if step_size is None else step_size
         return numpy.floor(coordinate / step_size) * step_size
 
     def bucket_fire(self, fire):
@@ -89,6 +108,46 @@ class Aggregator:
 
         self.buckets[key].add_data(cause, acres)
 
+    # Buckets many fires at once from arrays of coordinates, dates, cause codes and acres.
+    # Acres are summed in row order, so the buckets match calling bucket_fire row by row.
+    def bucket_fires(self, latitudes, longitudes, months, years, stat_cause_codes, acres):
+        new_latitudes = self.round_coordinate(latitudes)
+        new_longitudes = self.round_coordinate(longitudes)
+        codes, keys = pandas.MultiIndex.from_arrays(
+            [new_latitudes, new_longitudes, months, years]).factorize()
+        buckets = []
+        for latitude, longitude, month, year in keys:
+            key = Aggregator.Key(latitude, longitude, int(month), int(year))
+            if key not in self.buckets:
+                self.buckets[key] = Aggregator.Bucket()
+            buckets.append(self.buckets[key])
+
+        natural = stat_cause_codes == 1
+        unknown = stat_cause_codes == 13
+        human = ~natural & ~unknown
+        for attribute, is_cause in [
+            ('natural_acres_burned', natural),
+            ('human_acres_burned', human),
+            ('unknown_acres_burned', unknown)]:
+            # Each bucket's current total goes ahead of the new acres so bincount adds onto it
+            totals = numpy.bincount(
+                numpy.concatenate([numpy.arange(len(buckets)), codes]),
+                weights=numpy.concatenate([
+                    [getattr(bucket, attribute) for bucket in buckets],
+                    numpy.where(is_cause, acres, 0.0)]),
+                minlength=len(buckets))
+            for bucket, total in zip(buckets, totals.tolist()):
+                setattr(bucket, attribute, total)
+
+    # Adds another aggregator's buckets into this one. Keys this aggregator hasn't seen are
+    # appended in the other aggregator's order, so merging in a fixed order is deterministic.
+    def merge(self, other):
+        for key, bucket in other.buckets.items():
+            if key not in self.buckets:
+                self.buckets[key] = Aggregator.Bucket()
+            self.buckets[key].merge(bucket)
+        return self
+
     def to_dictionary_list(self):
         dictionaries = []
         for key in self.buckets:
@@ -122,8 +181,68 @@ def aggregate_fires_from_file(aggregator, file_name):
             fire = Fire(row)
             aggregator.bucket_fire(fire)
 
-def process_csvs(input_file_names, output_file_name):
-    aggregator = Aggregator()
-    for file_name in input_file_names:
-        aggregate_fires_from_file(aggregator, file_name)
-    write_dictionary_list(aggregator.to_dictionary_list(), output_file_name)
+# Years and months of an array of date strings. Each distinct date is parsed once.
+def parse_dates(dates, date_format=DATE_FORMAT):
+    codes, unique_dates = pandas.factorize(dates)
+    parsed = pandas.to_datetime(pandas.Series(unique_dates), format=date_format, errors='coerce')
+    years = parsed.dt.year.fillna(0).to_numpy(dtype=int)
+    months = parsed.dt.month.fillna(0).to_numpy(dtype=int)
+    for index in numpy.flatnonzero(parsed.isna().to_numpy()):
+        date = parse(unique_dates[index])
+        years[index] = date.year
+        months[index] = date.month
+    return years[codes], months[codes]
+
+# Reads only the needed columns of the CSV, CHUNK_SIZE rows at a time, and buckets each chunk
+# with array operations. Produces the same buckets as aggregate_fires_from_file.
+def aggregate_fire_chunks_from_file(aggregator, file_name, chunk_size=CHUNK_SIZE):
+    chunks = pandas.read_csv(
+        file_name,
+        usecols=FIRE_COLUMNS,
+        dtype={'discovery_date': str, 'cont_date': str},
+        keep_default_na=False,
+        float_precision='round_trip',
+        chunksize=chunk_size)
+    with metrics.stage('process.parse_rows') as timer:
+        for chunk in chunks:
+            timer.count(len(chunk))
+            aggregate_chunk(aggregator, chunk)
+
+def aggregate_chunk(aggregator, chunk):
+    discovery_dates = chunk['discovery_date'].to_numpy(dtype=object)
+    dates = numpy.where(discovery_dates == '', chunk['cont_date'].to_numpy(dtype=object), discovery_dates)
+    years, months = parse_dates(dates)
+    aggregator.bucket_fires(
+        chunk['latitude'].to_numpy(dtype=float),
+        chunk['longitude'].to_numpy(dtype=float),
+        months,
+        years,
+        chunk['stat_cause_code'].to_numpy(dtype=int),
+        chunk['fire_size'].to_numpy(dtype=float))
+
+def aggregate_shard(file_name, chunk_size=CHUNK_SIZE, grid_step=GRID_STEP):
+    aggregator = Aggregator(grid_step)
+    aggregate_fire_chunks_from_file(aggregator, file_name, chunk_size)
+    return aggregator
+
+def merge_shards(aggregator, shards):
+    for shard in shards:
+        with metrics.stage('process.merge_shards') as timer:
+            aggregator.merge(shard)
+            timer.count(1)
+
+# Every file is bucketed into its own aggregator and the results are merged in input order,
+# so the sums are added in the same order and the output is byte for byte the same with or
+# without workers. With workers, the files are bucketed in a process pool.
+def process_csvs(input_file_names, output_file_name, chunk_size=CHUNK_SIZE, workers=None, grid_step=GRID_STEP):
+    shard_aggregator = partial(aggregate_shard, chunk_size=chunk_size, grid_step=grid_step)
+    aggregator = Aggregator(grid_step)
+    if workers is None:
+        merge_shards(aggregator, map(shard_aggregator, input_file_names))
+    else:
+        with Pool(workers) as pool:
+            merge_shards(aggregator, pool.imap(shard_aggregator, input_file_names))
+    with metrics.stage('process.write_cells') as timer:
+        rows = aggregator.to_dictionary_list()
+        timer.count(len(rows))
+        write_dictionary_list(rows, output_file_name)
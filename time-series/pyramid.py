@@ -0,0 +1,47 @@
+from learn import ACRES_BURNED_COLUMNS, GRID_STEP
+
+import metrics
+import numpy
+import os
+import pandas
+
+# Levels of the pyramid, each with twice the grid step of the one below: 0.5, 1, 2 and 4 degrees
+PYRAMID_LEVELS = 4
+
+def level_steps(grid_step=GRID_STEP, levels=PYRAMID_LEVELS):
+    return [grid_step * 2 ** level for level in range(levels)]
+
+def level_file_name(output_directory, name, step):
+    return os.path.join(output_directory, '%s-%g.csv' % (name, step))
+
+# Sums the rows of a grid with the given step into cells factor times as large. Cells are
+# matched by integer index, since dividing the rounded coordinates by a step that isn't a power
+# of two in floating point can put a cell on the wrong side of a boundary. Coordinates stay
+# the south west corner of each cell, and cells are listed in the order they first appear.
+# Acres are added in row order.
+def coarsen(frame, grid_step, factor):
+    rows = numpy.floor_divide(numpy.round(frame.latitude.to_numpy(dtype=float) / grid_step).astype(numpy.int64), factor)
+    columns = numpy.floor_divide(numpy.round(frame.longitude.to_numpy(dtype=float) / grid_step).astype(numpy.int64), factor)
+    codes, keys = pandas.MultiIndex.from_arrays(
+        [rows, columns, frame.year.to_numpy(dtype=int), frame.month.to_numpy(dtype=int)]).factorize()
+    coarse = pandas.DataFrame(list(keys), columns=['latitude', 'longitude', 'year', 'month'])
+    coarse['latitude'] = coarse.latitude * (grid_step * factor)
+    coarse['longitude'] = coarse.longitude * (grid_step * factor)
+    for column in ACRES_BURNED_COLUMNS:
+        coarse[column] = numpy.bincount(codes, weights=frame[column].to_numpy(dtype=float), minlength=len(keys))
+    return coarse
+
+# Writes <name>-<step>.csv for every level of the pyramid. The first level is the input grid,
+# and each coarser level is summed from the level below it rather than from the raw fires.
+# Cells of every level are indexed in units of the level below, which is exact because each
+# level is twice the one below it.
+def build_pyramid(input_file_name, output_directory, name, grid_step=GRID_STEP, levels=PYRAMID_LEVELS):
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    frame = pandas.read_csv(input_file_name, float_precision='round_trip')
+    for level, step in enumerate(level_steps(grid_step, levels)):
+        with metrics.stage('pyramid.write_level') as timer:
+            if level > 0:
+                frame = coarsen(frame, step / 2, 2)
+            timer.count(len(frame))
+            frame.to_csv(level_file_name(output_directory, name, step), index=False)
@@ -0,0 +1,259 @@
+from main import GRID_STEP, PROCESSED_CSV_FILENAME, PREDICT_CSV_FILENAME
+from learn import FireTensor, NUMBER_OF_MONTHS_IN_YEAR
+
+import asyncio
+import numpy
+import pandas
+import sys
+from collections import OrderedDict
+from multiprocessing import Process
+from urllib.parse import parse_qs, urlsplit
+
+HOST = '127.0.0.1'
+PORT = 8000
+
+# Results with more rows than this are streamed with chunked encoding instead of being cached
+STREAM_THRESHOLD_ROWS = 50000
+STREAM_CHUNK_ROWS = 10000
+CACHE_ENTRIES = 4096
+CACHE_BYTES = 256 * 1024 * 1024
+MAX_REQUEST_BYTES = 16 * 1024
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+class QueryError(Exception):
+    pass
+
+# Cell ids of coordinates off the globe would wrap into other cells, so they are refused
+def check_coordinates(latitudes, longitudes):
+    if not all(-90 <= latitude <= 90 for latitude in latitudes):
+        raise QueryError('Latitudes must be between -90 and 90')
+    if not all(-180 <= longitude <= 180 for longitude in longitudes):
+        raise QueryError('Longitudes must be between -180 and 180')
+
+# Historical and predicted rows held as columns sorted by month and then cell, so a time range
+# is one contiguous slice and a cell or bounding box within it is a vectorized mask. Every row
+# is formatted as a CSV line once, when it is loaded, and responses join the lines they select.
+class GridIndex:
+    def __init__(self, file_names, grid_step=GRID_STEP):
+        frame = pandas.concat([pandas.read_csv(file_name, float_precision='round_trip') for file_name in file_names])
+        self.grid_step = grid_step
+        months = frame.year.to_numpy(dtype=numpy.int64) * NUMBER_OF_MONTHS_IN_YEAR + frame.month.to_numpy(dtype=numpy.int64) - 1
+        cells = FireTensor.cell_ids_from_coordinates(
+            frame.latitude.to_numpy(dtype=float), frame.longitude.to_numpy(dtype=float), grid_step)
+        order = numpy.lexsort((cells, months))
+
+        self.months = months[order]
+        self.cells = cells[order]
+        self.latitudes = frame.latitude.to_numpy(dtype=float)[order]
+        self.longitudes = frame.longitude.to_numpy(dtype=float)[order]
+        self.header = frame.iloc[:0].to_csv(index=False).encode()
+        lines = frame.iloc[order].to_csv(index=False, header=False).encode().splitlines(True)
+        self.lines = numpy.empty(len(lines), dtype=object)
+        self.lines[:] = lines
+
+    # Bounds of the rows from the start month to the end month, both included
+    def month_range(self, start, end):
+        return numpy.searchsorted(self.months, start), numpy.searchsorted(self.months, end, side='right')
+
+    # Rows of the cell containing the point. Points on the north pole or the antimeridian at 180
+    # belong to the cells just below and west of them.
+    def cell_rows(self, latitude, longitude, start, end):
+        check_coordinates([latitude], [longitude])
+        latitude = min(latitude, 90 - self.grid_step)
+        longitude = min(longitude, 180 - self.grid_step)
+        cell = FireTensor.cell_ids_from_coordinates(
+            numpy.floor(numpy.array([latitude]) / self.grid_step) * self.grid_step,
+            numpy.floor(numpy.array([longitude]) / self.grid_step) * self.grid_step,
+            self.grid_step)[0]
+        first, last = self.month_range(start, end)
+        return first + numpy.flatnonzero(self.cells[first:last] == cell)
+
+    # Rows of the cells overlapping the box. Each row's coordinates are its cell's south west corner.
+    def bbox_rows(self, south, west, north, east, start, end):
+        check_coordinates([south, north], [west, east])
+        first, last = self.month_range(start, end)
+        latitudes = self.latitudes[first:last]
+        longitudes = self.longitudes[first:last]
+        inside = (latitudes + self.grid_step > south) & (latitudes <= north) & \
+            (longitudes + self.grid_step > west) & (longitudes <= east)
+        return first + numpy.flatnonzero(inside)
+
+    def csv_chunks(self, rows, chunk_rows=STREAM_CHUNK_ROWS):
+        yield self.header
+        for start in range(0, len(rows), chunk_rows):
+            yield b''.join(self.lines[rows[start:start + chunk_rows]])
+
+# Least recently used response bodies, bounded by count and by total size
+class ResponseCache:
+    def __init__(self, max_entries=CACHE_ENTRIES, max_bytes=CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+        return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= len(self.entries.pop(key))
+        self.entries[key] = body
+        self.bytes += len(body)
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+
+# Month number of a YYYY-MM parameter, or the default when it is missing
+def month_parameter(parameters, name, default):
+    if name not in parameters:
+        return default
+    try:
+        year, month = [int(part) for part in parameters[name][0].split('-')]
+    except ValueError:
+        raise QueryError(name + ' must be YYYY-MM')
+    if not 1 <= month <= NUMBER_OF_MONTHS_IN_YEAR:
+        raise QueryError(name + ' must be YYYY-MM')
+    return year * NUMBER_OF_MONTHS_IN_YEAR + month - 1
+
+def float_parameters(parameters, name, count):
+    if name not in parameters:
+        raise QueryError(name + ' is required')
+    try:
+        values = [float(value) for value in parameters[name][0].split(',')]
+    except ValueError:
+        raise QueryError(name + ' must be ' + str(count) + ' comma separated numbers')
+    if len(values) != count:
+        raise QueryError(name + ' must be ' + str(count) + ' comma separated numbers')
+    if not all(numpy.isfinite(values)):
+        raise QueryError(name + ' must be finite numbers')
+    return values
+
+# Serves CSV rows in the format of the render CSVs:
+#   GET /cell?point=<lat>,<lng>[&start=YYYY-MM][&end=YYYY-MM]
+#   GET /bbox?bbox=<south>,<west>,<north>,<east>[&start=YYYY-MM][&end=YYYY-MM]
+# Connections are kept alive between requests unless the client asks otherwise.
+class QueryServer:
+    def __init__(self, index, cache=None):
+        self.index = index
+        self.cache = ResponseCache() if cache is None else cache
+
+    def select_rows(self, path, parameters):
+        start = month_parameter(parameters, 'start', self.index.months[0] if len(self.index.months) else 0)
+        end = month_parameter(parameters, 'end', self.index.months[-1] if len(self.index.months) else -1)
+        if path == '/cell':
+            latitude, longitude = float_parameters(parameters, 'point', 2)
+            return self.index.cell_rows(latitude, longitude, start, end)
+        if path == '/bbox':
+            south, west, north, east = float_parameters(parameters, 'bbox', 4)
+            return self.index.bbox_rows(south, west, north, east, start, end)
+        return None
+
+    # A client that disconnects, even in the middle of a streamed response, just ends its connection
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                request_line, *header_lines = request.decode('latin-1').rstrip('\r\n').split('\r\n')
+                headers = dict(
+                    (name.strip().lower(), value.strip()) for name, _, value in
+                    (line.partition(':') for line in header_lines))
+                parts = request_line.split(' ')
+                if len(parts) != 3:
+                    await self.respond(writer, 400, b'Malformed request line\n', False)
+                    break
+                method, target, version = parts
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+                await self.handle_request(writer, method, target, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, writer, method, target, keep_alive):
+        if method != 'GET':
+            await self.respond(writer, 405, b'Only GET is supported\n', keep_alive)
+            return
+        body = self.cache.get(target)
+        if body is not None:
+            await self.respond(writer, 200, body, keep_alive)
+            return
+
+        url = urlsplit(target)
+        try:
+            rows = self.select_rows(url.path, parse_qs(url.query))
+        except QueryError as error:
+            await self.respond(writer, 400, (str(error) + '\n').encode(), keep_alive)
+            return
+        if rows is None:
+            await self.respond(writer, 404, b'Unknown path, use /cell or /bbox\n', keep_alive)
+            return
+
+        if len(rows) > STREAM_THRESHOLD_ROWS:
+            await self.stream(writer, rows, keep_alive)
+            return
+        body = b''.join(self.index.csv_chunks(rows))
+        self.cache.put(target, body)
+        await self.respond(writer, 200, body, keep_alive)
+
+    async def respond(self, writer, status, body, keep_alive):
+        writer.write(self.status_line(status, keep_alive) + b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        await writer.drain()
+
+    # Sends the rows in chunks, waiting for each to drain so slow clients don't buffer the whole result
+    async def stream(self, writer, rows, keep_alive):
+        writer.write(self.status_line(200, keep_alive) + b'Transfer-Encoding: chunked\r\n\r\n')
+        for chunk in self.index.csv_chunks(rows):
+            writer.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    def status_line(self, status, keep_alive):
+        content_type = b'text/csv' if status == 200 else b'text/plain'
+        return b'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nConnection: %s\r\n' % (
+            status, STATUS_TEXT[status].encode(), content_type, b'keep-alive' if keep_alive else b'close')
+
+async def serve_forever(server, host, port, reuse_port):
+    listener = await asyncio.start_server(
+        server.handle_connection, host, port, limit=MAX_REQUEST_BYTES, reuse_port=reuse_port)
+    async with listener:
+        await listener.serve_forever()
+
+def run_server(file_names, host=HOST, port=PORT, reuse_port=False, grid_step=GRID_STEP):
+    print("Loading " + ", ".join(file_names) + "...")
+    server = QueryServer(GridIndex(file_names, grid_step))
+    print("Serving " + str(len(server.index.lines)) + " rows on http://" + host + ":" + str(port))
+    asyncio.run(serve_forever(server, host, port, reuse_port))
+
+def option_value(name, default=None):
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+# With several workers, each process loads its own index and listens on the same port, and
+# the kernel spreads connections between them
+if __name__ == "__main__":
+    host = option_value("--host", HOST)
+    port = int(option_value("--port", PORT))
+    workers = int(option_value("--workers", 1))
+    file_names = [PROCESSED_CSV_FILENAME, PREDICT_CSV_FILENAME]
+    if workers == 1:
+        run_server(file_names, host, port)
+    else:
+        processes = [Process(target=run_server, args=(file_names, host, port, True)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
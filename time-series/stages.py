@@ -0,0 +1,81 @@
+import hashlib
+import json
+import metrics
+import os
+
+# A step of the pipeline. It is up to date while its inputs, parameters and outputs are the
+# same as when it last ran.
+class Stage:
+    def __init__(self, name, run, inputs, outputs, parameters):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.parameters = parameters
+
+# Runs stages in order, skipping the ones that are up to date. Content hashes of every input
+# and output are recorded in a JSON state file. Hashes are cached by file size and
+# modification time so unchanged files are not read again.
+class StageRunner:
+    def __init__(self, state_file_name):
+        self.state_file_name = state_file_name
+        self.state = {'stages': {}, 'digests': {}}
+        if os.path.exists(state_file_name):
+            with open(state_file_name) as state_file:
+                self.state = json.load(state_file)
+
+    def run(self, stages, force=(), only=None):
+        for stage in stages:
+            if only is not None and stage.name != only:
+                continue
+            signature = self.signature(stage)
+            if stage.name not in force and self.state['stages'].get(stage.name) == signature:
+                print("Skipping " + stage.name + ", already up to date")
+                continue
+            with metrics.stage(stage.name):
+                stage.run()
+            self.record(stage)
+
+    # Marks a stage as up to date with its current inputs and outputs, for outputs that were
+    # rewritten outside of run()
+    def record(self, stage):
+        self.state['stages'][stage.name] = self.signature(stage)
+        self.save()
+
+    def signature(self, stage):
+        return {
+            'inputs': {file_name: self.digest(file_name) for file_name in stage.inputs},
+            'outputs': {file_name: self.digest(file_name) for file_name in stage.outputs},
+            'parameters': stage.parameters
+        }
+
+    # Digest of a file, or of every file under a directory. None when it doesn't exist.
+    def digest(self, path):
+        if os.path.isdir(path):
+            digest = hashlib.sha1()
+            for directory, _, file_names in sorted(os.walk(path)):
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(directory, file_name)
+                    digest.update((os.path.relpath(file_path, path) + self.digest(file_path)).encode())
+            return digest.hexdigest()
+        if not os.path.exists(path):
+            return None
+
+        status = os.stat(path)
+        cached = self.state['digests'].get(path)
+        if cached is not None and cached['size'] == status.st_size and cached['mtime'] == status.st_mtime_ns:
+            return cached['digest']
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        self.state['digests'][path] = {
+            'size': status.st_size,
+            'mtime': status.st_mtime_ns,
+            'digest': digest.hexdigest()
+        }
+        return digest.hexdigest()
+
+    def save(self):
+        with open(self.state_file_name, 'w') as state_file:
+            json.dump(self.state, state_file, indent=2)
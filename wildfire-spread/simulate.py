@@ -0,0 +1,329 @@
+import importlib.util
+import math
+import numpy
+import os
+import sys
+import time
+from multiprocessing import Pool
+from PIL import Image
+
+# Headless version of the model in wildfire.js. The parameters and state machine are the ones
+# in constants.js and utils.js.
+STATE_EMPTY = 0
+STATE_TREE = STATE_EMPTY + 1
+STATE_BURNING = STATE_TREE + 1
+STATE_BURNED = STATE_BURNING + 1
+
+ENERGY_TRANSFER_RATE_MEAN = 0.5
+ENERGY_TRANSFER_RATE_STD_DEV = 0.25
+
+PROBABILITY_OF_FIRE_TRANSFER = 0.1
+
+MAX_FUEL = 100
+
+INITIAL_ENERGY_MEAN = 50
+INITIAL_ENERGY_STD_DEV = 25
+
+REGROWTH_K_ITERATIONS = 5
+SHARPEN_AMOUNT = 0.3
+
+MAX_HUE_DELTA = 36
+BURNABLE_AREA_HUE = 90
+MAX_TREE_VALUE = 50
+MIN_TREE_SATURATION = 20
+
+RANDOM_BURN_RATE_PROBABILITY = 0.00000216465
+
+# Neighbors in the order areAnyNeighborsBurning visits them, as (dx, dy)
+NEIGHBOR_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx != 0 or dy != 0]
+
+NEVER_BURNED = -1
+
+ITERATIONS = 1000
+MEMBERS = 16
+OUTPUT_PREFIX = "output/burn-probability"
+
+TERRAIN_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "terrain")
+
+# Math.round, which rounds halves up
+def roundHalfUp(values):
+    return numpy.floor(values + 0.5)
+
+# sharpenImage from utils.js. Pixels outside the image count as zero and the result is
+# rounded and clamped the way a Uint8ClampedArray stores it.
+def sharpenImage(rgb, amount=SHARPEN_AMOUNT):
+    source = rgb.astype(numpy.float64)
+    padded = numpy.pad(source, ((1, 1), (1, 1), (0, 0)))
+    sharpened = 5 * source - padded[:-2, 1:-1] - padded[2:, 1:-1] - padded[1:-1, :-2] - padded[1:-1, 2:]
+    return numpy.clip(numpy.rint(sharpened * amount + source * (1 - amount)), 0, 255).astype(numpy.uint8)
+
+# rgb2hsv from utils.js: hue in whole degrees, saturation and value in percent to two decimals
+def hsvFromRgb(rgb):
+    absolute = rgb.astype(numpy.float64) / 255
+    r = absolute[..., 0]
+    g = absolute[..., 1]
+    b = absolute[..., 2]
+    v = numpy.maximum(numpy.maximum(r, g), b)
+    diff = v - numpy.minimum(numpy.minimum(r, g), b)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rr = (v - r) / 6 / diff + 1 / 2
+        gg = (v - g) / 6 / diff + 1 / 2
+        bb = (v - b) / 6 / diff + 1 / 2
+        h = numpy.where(r == v, bb - gg, numpy.where(g == v, (1 / 3) + rr - bb, (2 / 3) + gg - rr))
+        s = diff / v
+    h = numpy.where(h < 0, h + 1, numpy.where(h > 1, h - 1, h))
+    h[diff == 0] = 0
+    s[diff == 0] = 0
+    return roundHalfUp(h * 360), roundHalfUp(s * 100 * 100) / 100, roundHalfUp(v * 100 * 100) / 100
+
+# Fuel capacity of every pixel, classified as in Controller._startModel. Pixels that are not
+# trees get no fuel.
+def fuelFromImage(rgb):
+    h, s, v = hsvFromRgb(sharpenImage(rgb))
+    isTree = (BURNABLE_AREA_HUE - MAX_HUE_DELTA < h) & (h < BURNABLE_AREA_HUE + MAX_HUE_DELTA) & \
+        (v < MAX_TREE_VALUE) & (s >= MIN_TREE_SATURATION)
+    return numpy.where(isTree, MAX_FUEL * (MAX_HUE_DELTA - numpy.abs(BURNABLE_AREA_HUE - h)) / MAX_HUE_DELTA, 0)
+
+# Fuel capacity from the terrain model instead: each pixel's hue is quantized as in
+# terrain/main.py, with the bins the averages were written with, and its overlay alpha, which
+# grows as the hue's average distance to a fire shrinks, is scaled to MAX_FUEL. Hues the
+# terrain model ignores get no fuel.
+def fuelFromTerrain(rgb, averagesFile):
+    sys.path.insert(0, TERRAIN_DIRECTORY)
+    spec = importlib.util.spec_from_file_location("terrain_main", os.path.join(TERRAIN_DIRECTORY, "main.py"))
+    terrain = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(terrain)
+    featureBins = terrain.readFeatureBins(averagesFile)
+    hueAlphas = terrain.loadHueAlphas(averagesFile, featureBins)
+    return hueAlphas[featureBins.codes(rgb.astype(numpy.float64))] * (MAX_FUEL / 255)
+
+# distanceInMiles from utils.js
+def distanceInMiles(lat1, lng1, lat2, lng2):
+    if lat1 == lat2 and lng1 == lng2:
+        return 0
+    radlat1 = math.pi * lat1 / 180
+    radlat2 = math.pi * lat2 / 180
+    radtheta = math.pi * (lng1 - lng2) / 180
+    dist = min(1, math.sin(radlat1) * math.sin(radlat2) + math.cos(radlat1) * math.cos(radlat2) * math.cos(radtheta))
+    return math.acos(dist) * 180 / math.pi * 60 * 1.1515
+
+# Miles per pixel of a width x height image covering the given bounds, as in Controller._startModel
+def milesPerPixel(south, west, north, east, width, height):
+    return distanceInMiles(south, west, north, east) / math.sqrt(width * width + height * height)
+
+# One run of the model over a grid, held as one array per CellState field. Only burning cells,
+# their neighbors and randomly ignited trees are visited each iteration. Regrowing trees are
+# not stepped at all: their fuel only depends on how long ago they burned, so it is computed
+# from regrowthStart when it is needed.
+class Simulation:
+    def __init__(self, fuelCapacity, milesPerPixel, random, ignitions=()):
+        self.height, self.width = fuelCapacity.shape
+        self.random = random
+        self.burnProbability = RANDOM_BURN_RATE_PROBABILITY * milesPerPixel
+        self.iteration = 0
+
+        capacity = fuelCapacity.ravel()
+        self.fuelCells = numpy.flatnonzero(capacity > 0)
+        self.state = numpy.where(capacity > 0, STATE_TREE, STATE_EMPTY).astype(numpy.uint8)
+        self.fuelCapacity = capacity.astype(numpy.float64)
+        self.fuel = self.fuelCapacity.copy()
+        self.burnRate = numpy.zeros(len(capacity))
+        # Iteration at which a burned cell became a tree again, from which iterationsSinceBurned follows
+        self.regrowthStart = numpy.full(len(capacity), NEVER_BURNED, dtype=numpy.int64)
+        self.everBurned = numpy.zeros(len(capacity), dtype=bool)
+        self.treeCount = len(self.fuelCells)
+
+        self.burning = numpy.zeros(0, dtype=numpy.int64)
+        self.burned = numpy.zeros(0, dtype=numpy.int64)
+        cells = numpy.array([y * self.width + x for x, y in ignitions], dtype=numpy.int64)
+        cells = cells[self.state[cells] == STATE_TREE]
+        self.ignite(cells, self.random.normal(INITIAL_ENERGY_MEAN, INITIAL_ENERGY_STD_DEV, len(cells)), self.fuel[cells])
+
+    # Fuel of tree cells at the current iteration. updateFuelForTimestamp leaves unburned trees
+    # alone and gives regrowing ones fuelCapacity * k / (REGROWTH_K_ITERATIONS + k).
+    def treeFuel(self, cells):
+        regrowing = self.regrowthStart[cells] != NEVER_BURNED
+        iterations = self.iteration - self.regrowthStart[cells]
+        capacity = self.fuelCapacity[cells]
+        return numpy.where(
+            regrowing,
+            numpy.minimum(capacity, (capacity * iterations) / (REGROWTH_K_ITERATIONS + iterations)),
+            self.fuel[cells])
+
+    # Flat indexes of the in bounds neighbors (dx, dy) of cells, and which cells have one
+    def neighbors(self, cells, dx, dy):
+        y, x = numpy.divmod(cells, self.width)
+        inBounds = (x + dx >= 0) & (x + dx < self.width) & (y + dy >= 0) & (y + dy < self.height)
+        return cells + dy * self.width + dx, inBounds
+
+    # Burn rate of the first burning neighbor of each cell, in the order areAnyNeighborsBurning
+    # checks them, or 0 when none is burning
+    def neighborBurningRates(self, cells):
+        rates = numpy.zeros(len(cells))
+        found = numpy.zeros(len(cells), dtype=bool)
+        for dx, dy in NEIGHBOR_OFFSETS:
+            neighbors, inBounds = self.neighbors(cells, dx, dy)
+            burning = inBounds & ~found
+            burning[burning] = self.state[neighbors[burning]] == STATE_BURNING
+            rates[burning] = self.burnRate[neighbors[burning]]
+            found |= burning
+        return rates
+
+    # Trees next to a burning cell, each with the burn rate that would spread to it
+    def adjacentTrees(self):
+        candidates = numpy.unique(numpy.concatenate([
+            neighbors[inBounds] for neighbors, inBounds in
+            (self.neighbors(self.burning, dx, dy) for dx, dy in NEIGHBOR_OFFSETS)]))
+        candidates = candidates[self.state[candidates] == STATE_TREE]
+        rates = self.neighborBurningRates(candidates)
+        return candidates[rates > 0], rates[rates > 0]
+
+    # Every tree catches fire on its own with the same small probability, so the number that
+    # do is binomial and they are a uniform sample of the trees. Trees are drawn from the cells
+    # with fuel, skipping the ones that are burning or burned.
+    def randomlyIgnitedTrees(self):
+        count = self.random.binomial(self.treeCount, self.burnProbability) if self.treeCount else 0
+        picked = numpy.zeros(0, dtype=numpy.int64)
+        while len(picked) < count:
+            draws = self.fuelCells[self.random.integers(0, len(self.fuelCells), 2 * count)]
+            draws = numpy.concatenate([picked, draws[self.state[draws] == STATE_TREE]])
+            _, first = numpy.unique(draws, return_index=True)
+            picked = draws[numpy.sort(first)]
+        picked = picked[:count]
+        # Trees next to a fire follow the spreading rule instead
+        return picked[self.neighborBurningRates(picked) <= 0]
+
+    def ignite(self, cells, burnRates, fuel):
+        self.state[cells] = STATE_BURNING
+        self.burnRate[cells] = burnRates
+        self.fuel[cells] = fuel
+        self.regrowthStart[cells] = NEVER_BURNED
+        self.everBurned[cells] = True
+        self.treeCount -= len(cells)
+        self.burning = numpy.union1d(self.burning, cells)
+
+    # StateTransition.computeNextState. Every decision is made from the current state before
+    # any cell is updated.
+    def step(self):
+        adjacent, neighborRates = self.adjacentTrees()
+        randomValues = self.random.random(len(adjacent))
+        transferRates = numpy.clip(
+            self.random.normal(ENERGY_TRANSFER_RATE_MEAN, ENERGY_TRANSFER_RATE_STD_DEV, len(adjacent)), 0, 1)
+        transferredEnergy = transferRates * neighborRates
+        adjacentFuel = self.treeFuel(adjacent)
+        spreads = (transferredEnergy != 0) & ~(self.fuelCapacity[adjacent] * 0.8 > adjacentFuel) & \
+            (randomValues < PROBABILITY_OF_FIRE_TRANSFER)
+        ignited = self.randomlyIgnitedTrees()
+
+        # updateBurnForTimestamp
+        remainingFuel = self.fuel[self.burning] - self.burnRate[self.burning]
+        burnsOut = (remainingFuel < 0) | (self.burnRate[self.burning] < INITIAL_ENERGY_MEAN - INITIAL_ENERGY_STD_DEV)
+        burnedOut = self.burning[burnsOut]
+        self.burning = self.burning[~burnsOut]
+        self.fuel[self.burning] = remainingFuel[~burnsOut]
+
+        # Cells burned in the last iteration become trees with no fuel
+        self.state[self.burned] = STATE_TREE
+        self.regrowthStart[self.burned] = self.iteration + 1
+        self.treeCount += len(self.burned)
+
+        self.state[burnedOut] = STATE_BURNED
+        self.burnRate[burnedOut] = 0
+        self.fuel[burnedOut] = 0
+        self.burned = burnedOut
+
+        self.ignite(adjacent[spreads], transferredEnergy[spreads], adjacentFuel[spreads])
+        self.ignite(
+            ignited,
+            self.random.normal(INITIAL_ENERGY_MEAN, INITIAL_ENERGY_STD_DEV, len(ignited)),
+            self.treeFuel(ignited))
+        self.iteration += 1
+
+    def run(self, iterations):
+        for _ in range(iterations):
+            self.step()
+        return self
+
+# Ensemble members run in worker processes that share the fuel map set up by this initializer
+workerSettings = {}
+
+def initializeWorker(fuelCapacity, milesPerPixel, ignitions, iterations):
+    workerSettings.update(fuelCapacity=fuelCapacity, milesPerPixel=milesPerPixel, ignitions=ignitions, iterations=iterations)
+
+def runMember(seedSequence):
+    simulation = Simulation(
+        workerSettings['fuelCapacity'],
+        workerSettings['milesPerPixel'],
+        numpy.random.default_rng(seedSequence),
+        workerSettings['ignitions'])
+    return simulation.run(workerSettings['iterations']).everBurned
+
+# Fraction of the ensemble members in which each cell burned at least once. Every member has
+# its own random stream spawned from the seed, so the result doesn't depend on the number of
+# workers.
+def burnProbability(fuelCapacity, milesPerPixel, members=MEMBERS, iterations=ITERATIONS, seed=0, ignitions=(), workers=None):
+    seedSequences = numpy.random.SeedSequence(seed).spawn(members)
+    settings = (fuelCapacity, milesPerPixel, list(ignitions), iterations)
+    burnCounts = numpy.zeros(fuelCapacity.size, dtype=numpy.int64)
+    if workers is None:
+        initializeWorker(*settings)
+        for everBurned in map(runMember, seedSequences):
+            burnCounts += everBurned
+    else:
+        with Pool(workers, initializer=initializeWorker, initargs=settings) as pool:
+            for everBurned in pool.imap_unordered(runMember, seedSequences):
+                burnCounts += everBurned
+    return (burnCounts / members).reshape(fuelCapacity.shape)
+
+def saveBurnProbability(probability, outputPrefix):
+    directory = os.path.dirname(outputPrefix)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    numpy.save(outputPrefix + ".npy", probability)
+    Image.fromarray(numpy.rint(probability * 255).astype(numpy.uint8), 'L').save(outputPrefix + ".png")
+
+def optionValue(name, default=None):
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+def optionValues(name):
+    return [sys.argv[index + 1] for index, argument in enumerate(sys.argv[:-1]) if argument == name]
+
+# Worker processes import this module, so only run a simulation when executed directly
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1].startswith("--"):
+        print("Usage: python simulate.py <image> [--members N] [--iterations N] [--workers N] [--seed N]"
+            " [--miles-per-pixel X | --bounds south,west,north,east] [--terrain-averages FILE]"
+            " [--ignite x,y]... [--output PREFIX]")
+        sys.exit(1)
+
+    rgb = numpy.asarray(Image.open(sys.argv[1]).convert('RGB'))
+    averagesFile = optionValue("--terrain-averages")
+    fuelCapacity = fuelFromImage(rgb) if averagesFile is None else fuelFromTerrain(rgb, averagesFile)
+
+    scale = float(optionValue("--miles-per-pixel", 1))
+    if optionValue("--bounds") is not None:
+        south, west, north, east = [float(value) for value in optionValue("--bounds").split(",")]
+        scale = milesPerPixel(south, west, north, east, rgb.shape[1], rgb.shape[0])
+
+    members = int(optionValue("--members", MEMBERS))
+    iterations = int(optionValue("--iterations", ITERATIONS))
+    workers = optionValue("--workers")
+    ignitions = [tuple(int(value) for value in point.split(",")) for point in optionValues("--ignite")]
+    outputPrefix = optionValue("--output", OUTPUT_PREFIX)
+
+    start = time.perf_counter()
+    probability = burnProbability(
+        fuelCapacity,
+        scale,
+        members,
+        iterations,
+        int(optionValue("--seed", 0)),
+        ignitions,
+        None if workers is None else int(workers))
+    elapsed = time.perf_counter() - start
+    saveBurnProbability(probability, outputPrefix)
+    print("Ran %d members of %d iterations in %.2fs (%.0f iterations per second)" % (
+        members, iterations, elapsed, members * iterations / elapsed))
+    print("Burn probability written to " + outputPrefix + ".npy and " + outputPrefix + ".png")